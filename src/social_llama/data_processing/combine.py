@@ -10,7 +10,6 @@ from datasets import Dataset
 from datasets import DatasetDict
 from datasets import interleave_datasets
 from datasets.formatting.formatting import LazyRow
-from transformers import AutoTokenizer
 from trl.trainer import ConstantLengthDataset
 
 from social_llama.config import Configs
@@ -20,6 +19,7 @@ from social_llama.data_processing.social_dimensions import (
 from social_llama.data_processing.social_dimensions import SocialDimensions
 from social_llama.data_processing.socket import Sample as SocketSample
 from social_llama.data_processing.socket import Socket
+from social_llama.utils import load_tokenizer
 
 
 class Combined:
@@ -32,9 +32,10 @@ class Combined:
         self.socket_dataset = Socket(task="zero-shot", model=model)
         self.train_data: Union[DatasetDict, Dataset, None] = None
         self.test_data: Union[DatasetDict, Dataset, None] = None
-        self.tokenizer = AutoTokenizer.from_pretrained(
+        self.tokenizer = load_tokenizer(
             self.model,
-            trust_remote_code=True,
+            use_fast=True,
+            trust_remote_code=False,
             add_special_tokens=False,
             add_eos_token=False,
             add_bos_token=False,
@@ -1,9 +1,13 @@
 """Dataclass to abstract the some data processing."""
 
+import itertools
 from abc import abstractmethod
 from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import FrozenSet
 from typing import List
-from typing import Tuple
+from typing import Set
 from typing import Union
 
 from datasets import Dataset
@@ -12,10 +16,10 @@ from datasets import IterableDataset
 from datasets import IterableDatasetDict
 from torch.utils.data import Dataset as TorchDataset
 from tqdm import tqdm
-from transformers import AutoTokenizer
 
 from social_llama.config import Configs
 from social_llama.config import DatasetConfig
+from social_llama.utils import load_tokenizer
 
 
 class DataClass(TorchDataset):
@@ -31,16 +35,22 @@ class DataClass(TorchDataset):
             DatasetDict, Dataset, IterableDataset, IterableDatasetDict, None
         ] = None
         self.config: DatasetConfig = config
+        # Set of the labels for constant time membership checks
+        self._labels_set: FrozenSet[str] = frozenset(self.config.labels)
         self.task: str = task
         self.llama_config = Configs()
         self.model = model
-        self.tokenizer = AutoTokenizer.from_pretrained(
+        self.tokenizer = load_tokenizer(
             self.model,
-            trust_remote_code=True,
+            use_fast=True,
+            trust_remote_code=False,
             add_special_tokens=False,
             add_eos_token=False,
             add_bos_token=False,
         )
+        # The slow Python tokenizers are too slow for packing the training data
+        if not self.tokenizer.is_fast:
+            raise ValueError(f"No fast tokenizer is available for {self.model}.")
         self.tokenizer.use_default_system_prompt = False
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = (
@@ -87,8 +97,11 @@ class DataClass(TorchDataset):
 
     @abstractmethod
     def _extract_few_shot_examples(
-        self, dataset: dict, seed: int = 42
-    ) -> Tuple[List[Any], Dataset]:
+        self,
+        label_examples: Dict[str, Deque[dict]],
+        used_texts: Set[str],
+        seed: int = 42,
+    ) -> List[Any]:
         """Extracts the few shot examples from the dataset.
 
         Function should be overwritten by the child class.
@@ -121,17 +134,17 @@ class DataClass(TorchDataset):
 
     def chars_token_ratio(self, dataset, tokenizer, nb_examples=400):
         """Estimate the average number of characters per token in the dataset."""
-        total_characters, total_tokens = 0, 0
-        for _, example in tqdm(
-            zip(range(nb_examples), iter(dataset)), total=nb_examples
-        ):
-            text = self._prompt_function(example)
-            # text = example["text"]
-            total_characters += len(text)
-            if tokenizer.is_fast:
-                total_tokens += len(tokenizer(text).tokens())
-            else:
-                total_tokens += len(tokenizer.tokenize(text))
+        texts: List[str] = [
+            self._prompt_function(example)
+            for example in tqdm(
+                itertools.islice(iter(dataset), nb_examples), total=nb_examples
+            )
+        ]
+        total_characters = sum(map(len, texts))
+
+        # Tokenize all the prompts in a single call, so the fast tokenizer can encode them as a batch
+        encodings = tokenizer(texts, add_special_tokens=False)
+        total_tokens = sum(len(encodings.tokens(i)) for i in range(len(texts)))
 
         return total_characters / total_tokens
 
@@ -0,0 +1,91 @@
+"""Packing of pre-tokenized examples into constant length sequences."""
+
+import random
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+from torch.utils.data import get_worker_info
+
+
+class PackedDataset(IterableDataset):
+    """Constant length sequences made from pre-tokenized examples.
+
+    Works like the ConstantLengthDataset from TRL, but the examples are formatted and tokenized once,
+    instead of on every pass over the data.
+    """
+
+    def __init__(
+        self,
+        input_ids: List[List[int]],
+        concat_token_id: int,
+        seq_length: int = 1024,
+        infinite: bool = False,
+        shuffle: bool = True,
+        seed: int = 42,
+    ) -> None:
+        """Initialize the PackedDataset.
+
+        Args:
+            input_ids (List[List[int]]): Token ids of each example
+            concat_token_id (int): Token id appended after each example
+            seq_length (int, optional): Length of the sequences. Defaults to 1024.
+            infinite (bool, optional): Whether to restart when all sequences are yielded. Defaults to False.
+            shuffle (bool, optional): Whether to shuffle the sequences on every pass. Defaults to True.
+            seed (int, optional): Seed for shuffling, shared by the DataLoader workers. Defaults to 42.
+
+        Raises:
+            ValueError: If the examples do not fill a single sequence
+        """
+        super().__init__()
+        self.num_examples = len(input_ids)
+        self.seq_length = seq_length
+        self.infinite = infinite
+        self.shuffle = shuffle
+        self.seed = seed
+
+        # Concatenate all the examples, and cut the stream into sequences, dropping the remainder
+        token_ids = np.concatenate(
+            [np.asarray(ids + [concat_token_id], dtype=np.int64) for ids in input_ids]
+        )
+        num_sequences = len(token_ids) // seq_length
+        if num_sequences == 0:
+            raise ValueError(
+                f"The examples have {len(token_ids)} tokens, fewer than a single sequence of {seq_length}."
+            )
+        self.sequences = token_ids[: num_sequences * seq_length].reshape(
+            num_sequences, seq_length
+        )
+
+    def __len__(self) -> int:
+        """Number of examples, as for the ConstantLengthDataset."""
+        return self.num_examples
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        """Yield the sequences as input ids and labels.
+
+        With several DataLoader workers, each worker yields its own share of the sequences.
+        """
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        epoch = 0
+        while True:
+            order = list(range(len(self.sequences)))
+            if self.shuffle:
+                # The same seed in every worker, so the shares do not overlap
+                random.Random(self.seed + epoch).shuffle(order)
+
+            share = order[worker_id::num_workers]
+            for index in share:
+                input_ids = torch.from_numpy(self.sequences[index].copy())
+                yield {"input_ids": input_ids, "labels": input_ids.clone()}
+
+            # A worker without sequences would loop forever without yielding
+            if not self.infinite or not share:
+                break
+            epoch += 1
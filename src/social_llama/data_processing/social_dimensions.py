@@ -4,25 +4,29 @@ import itertools
 import json
 import os
 import random
+from collections import Counter
 from collections import defaultdict
-from dataclasses import asdict
+from collections import deque
 from dataclasses import dataclass
+from pathlib import Path
 from typing import Any
-from typing import Callable
+from typing import Deque
 from typing import Dict
 from typing import List
+from typing import Set
 from typing import Tuple
 from typing import Union
 
+import numpy as np
+import pandas as pd
 from datasets import Dataset
-from datasets import load_dataset
 from datasets.formatting.formatting import LazyRow
-from trl.trainer import ConstantLengthDataset
 from typing_extensions import override
 
 from social_llama.config import DATA_DIR_SOCIAL_DIMENSIONS_PROCESSED
 from social_llama.data_processing.dataclass import DataClass
 from social_llama.data_processing.dataset_configs import SOCIAL_DIMENSIONS_CONFIG
+from social_llama.data_processing.packing import PackedDataset
 from social_llama.utils import save_json
 
 
@@ -68,11 +72,35 @@ class SocialDimensions(DataClass):
     def __init__(self, task: str, model: str) -> None:
         """Initialize the SocialDimensions class."""
         super().__init__(SOCIAL_DIMENSIONS_CONFIG, task=task, model=model)
+        self._train_path: Path = self.config.path / "train.json"
+        self._test_path: Path = self.config.path / "test.json"
+        # Template of the chosen and rejected responses for CoT
+        self._cot_response_template: str = (
+            "The text exhibits {description}. In particular in the part '{h_text!r}'.\n"
+            "Answer: {label}\n"
+        )
+        # The system prompt is identical for every example, so it is formatted once
+        self._system_role: str = "system" if "llama" in self.model else "user"
+        self._system_content: str = self.llama_config.get_chat_template(
+            self._system_role
+        )[0]["content"].format(prompt_prefix=self.config.prompt_prefix)
+        # Rendered chat templates keyed by task prompt, as duplicated texts render identically
+        self._prompt_cache: Dict[str, str] = {}
 
     def __getitem__(self, index) -> Any:
         """Get the item at the index."""
         return super().__getitem__(index)
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """Leave the rendered prompts out of the pickled state.
+
+        The state is pickled into the map workers and hashed into the fingerprint of the map,
+        which would otherwise change with whatever prompts happen to be cached.
+        """
+        state = self.__dict__.copy()
+        state["_prompt_cache"] = {}
+        return state
+
     def simple_json_solution(self) -> None:
         """Reads the data from the data directory.
 
@@ -81,34 +109,40 @@ class SocialDimensions(DataClass):
         with open(self.config.path) as f:
             data = json.load(f)
 
-        processes_data: List[dict[str, Any]] = []
+        df = pd.DataFrame(data)
+
+        # Label matrix with a row per example and a column per label. The columns keep the order
+        # of the keys in the file, so the samples of an example follow its key order as before
+        labels = np.array([label for label in df.columns if label in self._labels_set])
+        values = df[labels].fillna(-1).to_numpy()
+        # All the labels that are not 0
+        positive = values > 0
+        # All the labels that are 0
+        negative = values == 0
+
+        # One sample per positive label. Examples without positive labels are skipped
+        rows, positive_columns = np.nonzero(positive)
+
+        # Randomly select a negative label for each sample: draw its rank among the
+        # negatives of the row, and find the column where the running count exceeds it
+        negative_counts = negative.sum(axis=1)[rows]
+        negative_ranks = (
+            np.random.default_rng().random(len(rows)) * negative_counts
+        ).astype(int)
+        negative_columns = (
+            np.cumsum(negative, axis=1)[rows] <= negative_ranks[:, None]
+        ).sum(axis=1)
+
+        processes_data: List[dict[str, Any]] = pd.DataFrame(
+            {
+                "idx": rows.astype(str),
+                "text": df["text"].to_numpy()[rows],
+                "h_text": df["h_text"].to_numpy()[rows],
+                "response_good": labels[positive_columns],
+                "response_bad": labels[negative_columns],
+            }
+        ).to_dict("records")
 
-        for idx, example in enumerate(data):
-            # Get labels and their values
-            labels_counts = [
-                (label, value)
-                for label, value in example.items()
-                if label in self.config.labels
-            ]
-            # All the labels that are not 0
-            positive_labels = [label for label, value in labels_counts if value > 0]
-            # All the labels that are 0
-            negative_labels = [label for label, value in labels_counts if value == 0]
-
-            # If there are no positive labels, skip the example
-            if len(positive_labels) == 0:
-                continue
-
-            for positive in positive_labels:
-                sample = Sample(
-                    idx=str(idx),
-                    text=example["text"],
-                    h_text=example["h_text"],
-                    response_good=positive,
-                    # Randomly select a negative label
-                    response_bad=random.choice(negative_labels),
-                )
-                processes_data.append(asdict(sample))
         save_json(
             DATA_DIR_SOCIAL_DIMENSIONS_PROCESSED / "labeled_dataset_small.json",
             processes_data,
@@ -116,80 +150,63 @@ class SocialDimensions(DataClass):
 
     def get_data(self) -> None:
         """Reads the data from the data directory."""
-        train_data = load_dataset(
-            "json",
-            data_files=str(self.config.path / "train.json"),
-            split="train",
-        )
+        # The files are small, so they are read directly instead of through the datasets cache
+        with open(self._train_path) as f:
+            train_data = Dataset.from_list(json.load(f))
 
-        test_data = load_dataset(
-            "json",
-            data_files=str(self.config.path / "test.json"),
-            split="train",
-        )
+        with open(self._test_path) as f:
+            test_data = Dataset.from_list(json.load(f))
 
         # Append task to each sample (this is needed when combining datasets)
-        train_data = train_data.map(
-            lambda example: {
-                "idx": example["idx"],
-                "text": example["text"],
-                "h_text": example["h_text"],
-                "response_good": example["response_good"],
-                "response_bad": example["response_bad"],
-                "task": "social-dimensions",
-            }
+        train_data = train_data.add_column(
+            "task", ["social-dimensions"] * train_data.num_rows
         )
-
-        test_data = test_data.map(
-            lambda example: {
-                "idx": example["idx"],
-                "text": example["text"],
-                "h_text": example["h_text"],
-                "response_good": example["response_good"],
-                "response_bad": example["response_bad"],
-                "task": "social-dimensions",
-            }
+        test_data = test_data.add_column(
+            "task", ["social-dimensions"] * test_data.num_rows
         )
 
         self.set_data(train_data=train_data, test_data=test_data)
 
     @override
-    def preprocess_sft(self) -> Tuple[ConstantLengthDataset, ConstantLengthDataset]:
+    def preprocess_sft(self) -> Tuple[PackedDataset, PackedDataset]:
         """Preprocess the data."""
         print(
             f"Size of the train set: {len(self.train_data)}. Size of the test set: {len(self.test_data)}"  # type: ignore
         )
 
-        chars_per_token = self.chars_token_ratio(self.train_data, self.tokenizer)
-        print(f"The character to token ratio of the dataset is: {chars_per_token:.2f}")
-
         if self.task == "few-shot":
             # Construct the dataset as few-shot
             self.train_data = self._apply_few_shot_prompt_stf(self.train_data)
             self.test_data = self._apply_few_shot_prompt_stf(self.test_data)
 
-        formatting_func: Callable = self._prompt_function
+        train_dataset = self._pack(self.train_data)
+        test_dataset = self._pack(self.test_data)
 
-        train_dataset = ConstantLengthDataset(
-            self.tokenizer,
-            self.train_data,
-            formatting_func=formatting_func,
-            infinite=True,
-            seq_length=1024,
-            chars_per_token=chars_per_token,
-        )
+        return train_dataset, test_dataset
 
-        test_dataset = ConstantLengthDataset(
-            self.tokenizer,
-            self.test_data,
-            formatting_func=formatting_func,
-            infinite=True,
+    def _pack(self, dataset: Dataset) -> PackedDataset:
+        """Format and tokenize the dataset once, and pack it into constant length sequences.
+
+        Args:
+            dataset (Dataset): Dataset to pack
+
+        Returns:
+            PackedDataset: Packed sequences of the dataset
+        """
+        prompts = self._prompt_function_batch(dataset.to_list())
+        # Special tokens are added as the ConstantLengthDataset did
+        input_ids = self.tokenizer(prompts, truncation=False)["input_ids"]
+
+        chars_per_token = sum(map(len, prompts)) / sum(map(len, input_ids))
+        print(f"The character to token ratio of the dataset is: {chars_per_token:.2f}")
+
+        return PackedDataset(
+            input_ids,
+            concat_token_id=self.tokenizer.eos_token_id,
             seq_length=1024,
-            chars_per_token=chars_per_token,
+            infinite=True,
         )
 
-        return train_dataset, test_dataset
-
     def _prompt_function(
         self, example: Union[Sample, List[Sample]], is_q_a: bool = False
     ) -> str:
@@ -201,19 +218,78 @@ class SocialDimensions(DataClass):
 
         Returns:
             str: Prompt for the example
+        """
+        return self._render_prompt(self._task_prompt(example, is_q_a=is_q_a))
 
-        Raises:
-            ValueError: If the task is not supported.
+    def _prompt_function_batch(
+        self, examples: List[Union[Sample, List[Sample]]], is_q_a: bool = False
+    ) -> List[str]:
+        """Generate prompts for a list of examples.
+
+        Args:
+            examples (List[Sample]): Samples of social dimensions examples
+            is_q_a (bool, optional): Whether the examples are question/answering examples. Defaults to False.
+
+        Returns:
+            List[str]: Prompts for the examples
         """
-        chat: List[Dict[str, str]] = self.llama_config.get_chat_template(
-            "system" if "llama" in self.model else "user"
-        )
+        return [
+            self._render_prompt(self._task_prompt(example, is_q_a=is_q_a))
+            for example in examples
+        ]
 
-        chat[0]["content"] = chat[0]["content"].format(
-            prompt_prefix=self.config.prompt_prefix
-            # prompt_prefix=""
-        )
+    def _render_prompt(self, task_prompt: str) -> str:
+        """Apply the chat template to a task prompt, reusing earlier renders.
+
+        Args:
+            task_prompt (str): The user part of the prompt
+
+        Returns:
+            str: Prompt with the chat template applied
+        """
+        prompt = self._prompt_cache.get(task_prompt)
+        if prompt is None:
+            prompt = self.tokenizer.apply_chat_template(
+                self._build_chat(task_prompt),
+                tokenize=False,
+                add_generation_prompt=True,
+            )
+            self._prompt_cache[task_prompt] = prompt
+        return prompt
+
+    def _build_chat(self, task_prompt: str) -> List[Dict[str, str]]:
+        """Build the chat messages for a task prompt.
+
+        Args:
+            task_prompt (str): The user part of the prompt
+
+        Returns:
+            List[Dict[str, str]]: Chat messages for the task prompt
+        """
+        if "llama" in self.model:
+            return [
+                {"role": self._system_role, "content": self._system_content},
+                {"role": "user", "content": task_prompt},
+            ]
+
+        # Gemma is not trained with a system prompt
+        return [{"role": "user", "content": f"{self._system_content} {task_prompt}"}]
+
+    def _task_prompt(
+        self, example: Union[Sample, List[Sample]], is_q_a: bool = False
+    ) -> str:
+        """Build the task specific part of the prompt.
+
+        Args:
+            example (Sample): Sample of a social dimensions example
+            is_q_a (bool, optional): Whether the example is a question/answering example. Defaults to False.
 
+        Returns:
+            str: Task prompt for the example
+
+        Raises:
+            ValueError: If the task is not supported.
+        """
         if self.task == "zero-shot":
             task_prompt = self.config.prompt_template.format(
                 text=example["text"],
@@ -253,54 +329,77 @@ class SocialDimensions(DataClass):
         else:
             raise ValueError(f"Type {type} is not supported.")
 
-        if "llama" in self.model:
-            chat.append(
-                {
-                    "role": "user",
-                    "content": task_prompt,
-                }
-            )
-        else:
-            chat[0] = {
-                "role": "user",
-                "content": f"{chat[0]['content']} {task_prompt}",  # Gemma is not trained with a system prompt
-            }
+        return task_prompt
 
-        return self.tokenizer.apply_chat_template(
-            chat, tokenize=False, add_generation_prompt=True
-        )
+    def _bucket_by_label(
+        self, dataset: Dataset, seed: int = 42
+    ) -> Tuple[Dict[str, Deque[dict]], Counter]:
+        """Group the shuffled examples of the dataset in a queue per label.
 
-    def _extract_few_shot_examples(
-        self, dataset, seed: int = 42
-    ) -> Tuple[List[dict], List[dict]]:
-        # Prepare a dictionary to hold examples for each label
-        label_examples = defaultdict(list)
-        num_few_shot_examples: int = self.config.num_few_shot_examples
+        The rows are visited in the order of np.random.default_rng(seed).permutation, which is the
+        order Dataset.shuffle(seed=seed) gives, without writing a shuffled indices mapping.
+
+        Args:
+            dataset (Dataset): Dataset to group
+            seed (int, optional): Seed for shuffling the examples. Defaults to 42.
+
+        Returns:
+            Tuple[Dict[str, Deque[dict]], Counter]: The examples per label and the number of examples per text
+        """
+        label_examples: Dict[str, Deque[dict]] = defaultdict(deque)
+        text_counts: Counter = Counter()
 
-        # Populate the dictionary
-        for example in dataset:
-            if example["response_good"] in self.config.labels:
+        rows: List[dict] = dataset.to_list()
+        for index in np.random.default_rng(seed).permutation(len(rows)):
+            example = rows[index]
+            if example["response_good"] in self._labels_set:
                 label_examples[example["response_good"]].append(example)
+                text_counts[example["text"]] += 1
+
+        return label_examples, text_counts
+
+    def _extract_few_shot_examples(
+        self,
+        label_examples: Dict[str, Deque[dict]],
+        used_texts: Set[str],
+        seed: int = 42,
+    ) -> List[dict]:
+        """Extract few shot examples, cycling through the labels.
+
+        The examples are popped from the label queues, and their texts are added to used_texts,
+        so that other examples with the same text are skipped in later calls.
+
+        Args:
+            label_examples (Dict[str, Deque[dict]]): Queue of unused examples for each label
+            used_texts (Set[str]): Texts already used in a few shot example
+            seed (int, optional): Seed for shuffling the examples. Defaults to 42.
+
+        Returns:
+            List[dict]: The few shot examples
+        """
+        num_few_shot_examples: int = self.config.num_few_shot_examples
 
         # Prepare the few_shot_examples list
-        few_shot_examples = []
+        few_shot_examples: List[dict] = []
         labels_cycle = itertools.cycle(self.config.labels)
 
         while len(few_shot_examples) < num_few_shot_examples:
             label = next(labels_cycle)
+            examples = label_examples[label]
+
+            # Skip examples whose text was used in an earlier few shot example
+            while examples and examples[0]["text"] in used_texts:
+                examples.popleft()
 
-            if label_examples[label]:
-                example = label_examples[label].pop(0)
-                few_shot_examples.append(example)
+            if examples:
+                few_shot_examples.append(examples.popleft())
 
         random.seed(seed)
         random.shuffle(few_shot_examples)
 
-        # Remove used examples from the original dataset
-        used_texts = {example["text"] for example in few_shot_examples}
-        remaining_dataset = [x for x in dataset if x["text"] not in used_texts]
+        used_texts.update(example["text"] for example in few_shot_examples)
 
-        return few_shot_examples, remaining_dataset
+        return few_shot_examples
 
     def _make_few_shot_example(self, few_shot_examples: List[Sample]) -> str:
         """Make a few shot example."""
@@ -315,15 +414,21 @@ class SocialDimensions(DataClass):
     @override
     def _apply_few_shot_prompt_stf(self, dataset, seed: int = 42) -> Dataset:
         """Applies the few shot prompt to the dataset."""
-        # Shuffle dataset
-        shuffled_data = dataset.shuffle(seed=seed)
+        # Shuffle the examples and group them by label once, and pop from the groups in the loop
+        label_examples, text_counts = self._bucket_by_label(dataset, seed=seed)
+        num_remaining = sum(text_counts.values())
+        used_texts: Set[str] = set()
 
         # All the samples after making them into a few shot example
         few_shot_collection = []
-        while shuffled_data.num_rows >= self.config.num_few_shot_examples:
+        while num_remaining >= self.config.num_few_shot_examples:
             # Extract few shot examples
-            few_shot_examples, shuffled_data = self._extract_few_shot_examples(
-                shuffled_data, seed=seed
+            few_shot_examples = self._extract_few_shot_examples(
+                label_examples, used_texts, seed=seed
+            )
+            num_remaining -= sum(
+                text_counts[text]
+                for text in {example["text"] for example in few_shot_examples}
             )
 
             # Add few shot examples to few shot dataset
@@ -332,7 +437,7 @@ class SocialDimensions(DataClass):
             # Every 1000 examples print the number of examples left
             if len(few_shot_collection) % 1000 == 0:
                 print(
-                    f"Number of examples left: {shuffled_data.num_rows}. Number of few shot examples: {len(few_shot_collection)}"
+                    f"Number of examples left: {num_remaining}. Number of few shot examples: {len(few_shot_collection)}"
                 )
 
         # Define new empty DatasetDict
@@ -370,72 +475,102 @@ class SocialDimensions(DataClass):
         elif self.task == "cot":
             return {
                 "prompt": self._prompt_function(samples, is_q_a=True),  # type: ignore
-                "chosen": f"The text exhibits {self.config.cot_info_dict[samples['response_good']]}. In particular in the part '{samples['h_text']!r}'.\nAnswer: {samples['response_good']}\n",  # type: ignore
-                "rejected": f"The text exhibits {self.config.cot_info_dict[samples['response_bad']]}. In particular in the part '{samples['h_text']!r}'.\nAnswer: {samples['response_bad']}\n",  # type: ignore
+                "chosen": self._cot_response_template.format_map(
+                    {
+                        "description": self.config.cot_info_dict[samples["response_good"]],  # type: ignore
+                        "h_text": samples["h_text"],  # type: ignore
+                        "label": samples["response_good"],  # type: ignore
+                    }
+                ),
+                "rejected": self._cot_response_template.format_map(
+                    {
+                        "description": self.config.cot_info_dict[samples["response_bad"]],  # type: ignore
+                        "h_text": samples["h_text"],  # type: ignore
+                        "label": samples["response_bad"],  # type: ignore
+                    }
+                ),
             }
         else:
             raise ValueError(f"Type {type} is not supported.")
 
+    def _convert_to_q_and_a_batched(
+        self, batch: Dict[str, List[Any]]
+    ) -> Dict[str, List[str]]:
+        """Convert a batch of the dataset to a question and answer dataset.
+
+        Args:
+            batch (Dict[str, List[Any]]): Batch of samples, as a dict of columns
+
+        Returns:
+            Dict[str, List[str]]: Columns with the prompts, chosen responses, and rejected responses
+        """
+        converted: Dict[str, List[str]] = defaultdict(list)
+        for values in zip(*batch.values()):
+            sample = self._convert_to_q_and_a(dict(zip(batch.keys(), values)))
+            for key, value in sample.items():
+                converted[key].append(value)
+        return dict(converted)
+
     def _apply_few_shot_prompt_dpo(self, dataset, seed: int = 42) -> Dataset:
         """Applies the few shot prompt to the dataset."""
-        # Shuffle dataset
-        shuffled_data = dataset.shuffle(seed=seed)
+        # Shuffle the examples and group them by label once, and pop from the groups in the loop
+        label_examples, text_counts = self._bucket_by_label(dataset, seed=seed)
+        num_remaining = sum(text_counts.values())
+        used_texts: Set[str] = set()
 
-        # All the samples after making them into a few shot example
-        few_shot_collection = []
+        # Columns of the few shot dataset, with a list of values per few shot example
+        columns = ("idx", "text", "h_text", "response_good", "response_bad")
+        few_shot_collection: Dict[str, List[list]] = {column: [] for column in columns}
 
-        while len(shuffled_data) >= self.config.num_few_shot_examples:
+        while num_remaining >= self.config.num_few_shot_examples:
             # Extract few shot examples
-            few_shot_examples, shuffled_data = self._extract_few_shot_examples(
-                shuffled_data, seed=seed
+            few_shot_examples = self._extract_few_shot_examples(
+                label_examples, used_texts, seed=seed
+            )
+            num_remaining -= sum(
+                text_counts[text]
+                for text in {example["text"] for example in few_shot_examples}
             )
 
             # Add few shot examples to few shot dataset
-            few_shot_collection.append(
-                {
-                    "idx": [example["idx"] for example in few_shot_examples],
-                    "text": [example["text"] for example in few_shot_examples],
-                    "h_text": [example["h_text"] for example in few_shot_examples],
-                    "response_good": [
-                        example["response_good"] for example in few_shot_examples
-                    ],
-                    "response_bad": [
-                        example["response_bad"] for example in few_shot_examples
-                    ],
-                }
-            )
+            for column in columns:
+                few_shot_collection[column].append(
+                    [example[column] for example in few_shot_examples]
+                )
+            num_few_shot = len(few_shot_collection["idx"])
 
             # Every 1000 examples print the number of examples left
-            if len(few_shot_collection) % 1000 == 0:
+            if num_few_shot % 1000 == 0:
                 print(
-                    f"Number of examples left: {len(shuffled_data)}. Number of few shot examples: {len(few_shot_collection)}"
+                    f"Number of examples left: {num_remaining}. Number of few shot examples: {num_few_shot}"
                 )
 
         # Define new empty DatasetDict
-        few_shot_dataset = Dataset.from_list(few_shot_collection)
+        few_shot_dataset = Dataset.from_dict(few_shot_collection)
 
         return few_shot_dataset
 
     @override
     def preprocess_dpo(self) -> Tuple[Dataset, Dataset]:
         """Preprocess for DPO. The data needs Q&A format."""
-        original_columns = self.train_data.column_names
-
         if self.task == "few-shot":
             self.train_data = self._apply_few_shot_prompt_dpo(self.train_data)
             self.test_data = self._apply_few_shot_prompt_dpo(self.test_data)
 
+        # Rendering the chat templates is pure Python, so it is spread over processes
         self.train_data = self.train_data.map(
-            self._convert_to_q_and_a,
-            # batched=True,
-            remove_columns=original_columns,
-            drop_last_batch=True,
+            self._convert_to_q_and_a_batched,
+            batched=True,
+            batch_size=512,
+            num_proc=os.cpu_count(),
+            remove_columns=self.train_data.column_names,
         )
         self.test_data = self.test_data.map(
-            self._convert_to_q_and_a,
-            # batched=True,
-            remove_columns=original_columns,
-            drop_last_batch=True,
+            self._convert_to_q_and_a_batched,
+            batched=True,
+            batch_size=512,
+            num_proc=os.cpu_count(),
+            remove_columns=self.test_data.column_names,
         )
 
         return self.train_data, self.test_data
@@ -1,24 +1,31 @@
 """Evaluation of the model."""
 
+import json
 import os
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Tuple
 from typing import Union
 
 import pandas as pd
 import torch
 from datasets import Dataset
-from datasets import disable_caching
 from datasets import load_dataset
 from dotenv import load_dotenv
 from huggingface_hub import InferenceClient
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import AutoConfig
-from transformers import AutoTokenizer
+from transformers import AutoModelForCausalLM
+from transformers import BitsAndBytesConfig
 from transformers import pipeline
+from transformers.pipelines.pt_utils import KeyDataset
 
 # from social_llama.config import DATA_DIR_EVALUATION_SOCIAL_DIMENSIONS
 from social_llama.config import DATA_DIR_EVALUATION_SOCKET
@@ -30,20 +37,62 @@ from social_llama.evaluation.helper_functions import label_finder
 from social_llama.reverse_instructions.instruction_configs import (
     ReverseInstructionsPrompts,
 )
+from social_llama.utils import call_with_retries
 from social_llama.utils import get_device
+from social_llama.utils import load_tokenizer
+from social_llama.utils import read_jsonl
 from social_llama.utils import save_json
+from social_llama.utils import select_random_rows
 
 
 load_dotenv()
 
-disable_caching()
+SOCKET_CLASSIFICATION_TASKS: Tuple[str, ...] = (
+    "hahackathon#is_humor",
+    "sarc",
+    "contextual-abuse#IdentityDirectedAbuse",
+    "contextual-abuse#PersonDirectedAbuse",
+    "tweet_irony",
+    "questionintimacy",
+    "tweet_emotion",
+    "hateoffensive",
+    "implicit-hate#explicit_hate",
+    "implicit-hate#implicit_hate",
+    "crowdflower",
+    "dailydialog",
+    "hasbiasedimplication",
+    "implicit-hate#stereotypical_hate",
+    "intentyn",
+    "tweet_offensive",
+    "empathy#distress_bin",
+    "complaints",
+    "hayati_politeness",
+    "stanfordpoliteness",
+    "hypo-l",
+    "rumor#rumor_bool",
+    "two-to-lie#receiver_truth",
+)
 
 
 class Evaluator:
     """Evaluator for our tasks dataset."""
 
-    def __init__(self, model_id: str) -> None:
-        """Initialize the evaluator."""
+    def __init__(
+        self, model_id: str, load_in_4bit: bool = False, use_vllm: bool = False
+    ) -> None:
+        """Initialize the evaluator.
+
+        Args:
+            model_id (str): Model to evaluate
+            load_in_4bit (bool, optional): Whether to quantize a local model to 4-bit NF4, which cuts
+                the weight memory that each decoding step reads. Defaults to False.
+            use_vllm (bool, optional): Whether to generate with vLLM instead of the transformers pipeline
+                for a local model. vLLM batches the prompts continuously with paged attention,
+                and has to be installed separately. Defaults to False.
+
+        Raises:
+            ImportError: If use_vllm is set and vLLM is not installed
+        """
         self.socket_tasks: List[str] = ["CLS", "REG", "PAIR", "SPAN"]
         self.model_id = model_id
         self.is_instruction = True if "instruction" in model_id else False
@@ -60,6 +109,19 @@ class Evaluator:
         # self.social_dimensions.get_data()
         self.chat_config = Configs()
         self.socket_prompts: pd.DataFrame
+        # The SOCKET prompts without and with knowledge about the labels, read once
+        self._zero_shot_prompts: pd.DataFrame = pd.read_csv(
+            DATA_DIR_EVALUATION_SOCKET / "socket_prompts.csv"
+        )
+        self._knowledge_prompts: pd.DataFrame = pd.read_csv(
+            DATA_DIR_EVALUATION_SOCKET / "socket_prompts_knowledge.csv"
+        )
+        # Test splits of the SOCKET tasks, reused by later predict calls
+        self._task_datasets: Dict[str, Dataset] = {}
+        # The chat layout only depends on the model, so it is chosen once
+        self._build_chat = (
+            self._build_chat_system if "llama" in model_id else self._build_chat_user
+        )
         self.generation_kwargs = {
             "max_new_tokens": 50,
             "temperature": 0.9,
@@ -70,16 +132,18 @@ class Evaluator:
             "max_new_tokens": 150,
             "temperature": 0.9,
             "do_sample": True,
+            # Only return the generated text, without the prompt
+            "return_full_text": False,
         }
         if "llama" in model_id:
-            self.tokenizer = AutoTokenizer.from_pretrained(
+            self.tokenizer = load_tokenizer(
                 # "meta-llama/Llama-2-7b-chat-hf"
                 "meta-llama/Meta-Llama-3-8B-Instruct"
             )
         elif "gemma" in model_id:
-            self.tokenizer = AutoTokenizer.from_pretrained("google/gemma-7b-it")
+            self.tokenizer = load_tokenizer("google/gemma-7b-it")
         else:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+            self.tokenizer = load_tokenizer(model_id)
         if model_id in [
             "meta-llama/Llama-2-7b-chat-hf",
             "meta-llama/Llama-2-7b-hf",
@@ -92,27 +156,102 @@ class Evaluator:
                 model=model_id, token=os.environ["HUGGINGFACEHUB_API_TOKEN"]
             )
             self.use_inference_client = True
+            self.use_vllm = False
         else:
+            self.use_vllm = use_vllm
             self.config = AutoConfig.from_pretrained(model_id)
             self.chat_config = Configs()
             self.device = get_device()
-            self.llm = pipeline(
-                "text-generation",
-                model=model_id,
-                tokenizer=self.tokenizer,
-                device_map="auto",
-                **self.generation_kwargs_local,
-            )
+            # Batched generation needs a pad token, and decoder-only models are padded on the left
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.tokenizer.padding_side = "left"
+            if use_vllm:
+                self._init_vllm(model_id, load_in_4bit)
+            else:
+                self._init_pipeline(model_id, load_in_4bit)
             self.use_inference_client = False
 
+    def _init_pipeline(self, model_id: str, load_in_4bit: bool) -> None:
+        """Load a local model into a transformers text-generation pipeline.
+
+        Args:
+            model_id (str): Model to load
+            load_in_4bit (bool): Whether to quantize the model to 4-bit NF4
+        """
+        # Decoding is memory bound, so the weights are loaded in bf16 instead of the default fp32
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=torch.bfloat16,
+            quantization_config=(
+                BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                )
+                if load_in_4bit
+                else None
+            ),
+            device_map="auto",
+        )
+        self.llm = pipeline(
+            "text-generation",
+            model=model,
+            tokenizer=self.tokenizer,
+            **self.generation_kwargs_local,
+        )
+
+    def _init_vllm(self, model_id: str, load_in_4bit: bool) -> None:
+        """Load a local model into a vLLM engine.
+
+        Args:
+            model_id (str): Model to load
+            load_in_4bit (bool): Whether to quantize the model with bitsandbytes
+
+        Raises:
+            ImportError: If vLLM is not installed
+        """
+        try:
+            from vllm import LLM
+            from vllm import SamplingParams
+        except ImportError as e:
+            raise ImportError(
+                "vLLM is not installed. Install it with `pip install vllm` to use use_vllm=True."
+            ) from e
+
+        self.llm = LLM(
+            model=model_id,
+            tokenizer=self.tokenizer.name_or_path,
+            dtype="bfloat16",
+            max_model_len=4096,
+            **(
+                {"quantization": "bitsandbytes", "load_format": "bitsandbytes"}
+                if load_in_4bit
+                else {}
+            ),
+        )
+        self.sampling_params = SamplingParams(
+            max_tokens=self.generation_kwargs_local["max_new_tokens"],
+            temperature=self.generation_kwargs_local["temperature"],
+        )
+
     def predict(
         self, task: str = "social-dimensions", batch_size: int = 8, note: str = ""
     ) -> None:
         """Predict the labels for the test data."""
-        self.socket_prompts: pd.DataFrame = pd.read_csv(
-            DATA_DIR_EVALUATION_SOCKET / "socket_prompts.csv"
-            if note == "zero-shot"
-            else DATA_DIR_EVALUATION_SOCKET / "socket_prompts_knowledge.csv"
+        self.socket_prompts = (
+            self._zero_shot_prompts if note == "zero-shot" else self._knowledge_prompts
+        )
+        # Look up the prompt and the knowledge of a task without filtering the DataFrame,
+        # using the first row of each task as before
+        task_prompts = self.socket_prompts.drop_duplicates("task")
+        self._prompt_by_task: Dict[str, str] = dict(
+            zip(task_prompts["task"], task_prompts["question"])
+        )
+        self._knowledge_by_task: Dict[str, str] = (
+            dict(zip(task_prompts["task"], task_prompts["knowledge"].fillna("")))
+            if "knowledge" in task_prompts.columns
+            else {}
         )
 
         if task == "social-dimensions":
@@ -135,107 +274,240 @@ class Evaluator:
             # predictions = self._process_samples(task_data, labels)
             # save_json(save_path, predictions)
         elif task == "socket":
-            for task in [
-                "hahackathon#is_humor",
-                "sarc",
-                "contextual-abuse#IdentityDirectedAbuse",
-                "contextual-abuse#PersonDirectedAbuse",
-                "tweet_irony",
-                "questionintimacy",
-                "tweet_emotion",
-                "hateoffensive",
-                "implicit-hate#explicit_hate",
-                "implicit-hate#implicit_hate",
-                "crowdflower",
-                "dailydialog",
-                "hasbiasedimplication",
-                "implicit-hate#stereotypical_hate",
-                "intentyn",
-                "tweet_offensive",
-                "empathy#distress_bin",
-                "complaints",
-                "hayati_politeness",
-                "stanfordpoliteness",
-                "hypo-l",
-                "rumor#rumor_bool",
-                "two-to-lie#receiver_truth",
-            ][::-1]:
-                task_data, labels = self._prepare_socket_test_data(task=task)
-                save_path = (
-                    DATA_DIR_EVALUATION_SOCKET
-                    / f"{task}/{self.model_id}_predictions_{note}.json"
-                )
-                task_data = DataLoader(
-                    task_data,
-                    batch_size=1 if self.use_inference_client else batch_size,
-                    shuffle=False,
-                    num_workers=0,
-                    drop_last=False,
-                    collate_fn=self.collate_fn,
-                )
-
-                predictions = self._process_samples(task_data, labels)
-                save_json(save_path, predictions)
+            # Skip the tasks that already have predictions from an earlier run
+            socket_tasks: List[str] = [
+                socket_task
+                for socket_task in SOCKET_CLASSIFICATION_TASKS
+                if not self._save_path(socket_task, note).exists()
+            ]
+            if not socket_tasks:
+                return
+            if self.use_inference_client:
+                # The requests are network bound, so a few tasks are evaluated at the same time.
+                # No worker processes are started on this path, so threads are safe here.
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    list(
+                        executor.map(
+                            lambda socket_task: self._run_one_task(
+                                socket_task, batch_size, note
+                            ),
+                            socket_tasks,
+                        )
+                    )
+            else:
+                # The local model runs one task at a time, without preparing the next task
+                # in a thread, as forking the pipeline workers from a threaded process can hang them
+                for socket_task in socket_tasks:
+                    self._run_one_task(socket_task, batch_size, note)
         else:
             raise ValueError("Task not recognized.")
 
-    def _process_samples(self, task_data, labels):
-        predictions = []
+    def _run_one_task(self, task: str, batch_size: int, note: str) -> None:
+        """Prepare, predict and save a single SOCKET task.
+
+        Args:
+            task (str): SOCKET task
+            batch_size (int): Batch size
+            note (str): Note added to the name of the predictions file
+        """
+        task_data, labels = self._prepare_socket_test_data(task=task)
+        self._predict_socket_task(task, task_data, labels, batch_size, note)
+
+    def _predict_socket_task(
+        self,
+        task: str,
+        task_data: List[Dict[str, Union[str, int]]],
+        labels: List[str],
+        batch_size: int,
+        note: str,
+    ) -> None:
+        """Predict the prepared samples of a SOCKET task and save the predictions.
+
+        Args:
+            task (str): SOCKET task
+            task_data (List[Dict[str, Union[str, int]]]): Samples with idx, prompt and label
+            labels (List[str]): Labels of the task
+            batch_size (int): Batch size
+            note (str): Note added to the name of the predictions file
+        """
+        save_path = self._save_path(task, note)
+        # Predictions are written to a JSON lines file as they are made,
+        # so an interrupted task continues with the samples that were not predicted yet
+        checkpoint_path = save_path.with_suffix(".jsonl")
+        predictions = read_jsonl(checkpoint_path)
+        predicted_idx = {prediction["idx"] for prediction in predictions}
+        task_data = [
+            sample for sample in task_data if sample["idx"] not in predicted_idx
+        ]
+
+        if not task_data:
+            new_predictions: Iterable[Dict[str, Any]] = []
+        elif self.use_inference_client:
+            # The samples are already in memory, so the batches are plain slices of them
+            task_batches = [
+                self.collate_fn(task_data[i : i + batch_size])
+                for i in range(0, len(task_data), batch_size)
+            ]
+            new_predictions = self._process_samples(task_batches, labels)
+        elif self.use_vllm:
+            new_predictions = self._process_samples_vllm(task_data, labels)
+        else:
+            new_predictions = self._process_samples_pipeline(
+                task_data, labels, batch_size
+            )
+
+        checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint_file:
+            for prediction in new_predictions:
+                checkpoint_file.write(json.dumps(prediction, ensure_ascii=False) + "\n")
+                checkpoint_file.flush()
+                predictions.append(prediction)
+
+        predictions.sort(key=lambda prediction: prediction["idx"])
+        save_json(save_path, predictions)
+        checkpoint_path.unlink()
+
+    def _save_path(self, task: str, note: str) -> Path:
+        """Path of the predictions file of a SOCKET task.
+
+        Args:
+            task (str): SOCKET task
+            note (str): Note added to the name of the predictions file
+
+        Returns:
+            Path: Path of the predictions file
+        """
+        return (
+            DATA_DIR_EVALUATION_SOCKET
+            / f"{task}/{self.model_id}_predictions_{note}.json"
+        )
+
+    def _num_workers(self) -> int:
+        """Number of workers the local pipeline tokenizes the next batches with.
+
+        Scales with the CPU cores available to the process.
+        """
+        if hasattr(os, "sched_getaffinity"):
+            num_cpus = len(os.sched_getaffinity(0))
+        else:
+            num_cpus = os.cpu_count() or 1
+        return min(8, num_cpus)
+
+    def _process_samples(self, task_data, labels) -> Iterator[Dict[str, Any]]:
         for batch in tqdm(task_data):
             batch_predictions: List[str] = self._predict(batch)
 
             for idx, prompt, label, prediction in zip(
                 batch["idx"], batch["prompt"], batch["label"], batch_predictions
             ):
-                prediction_processed = label_check(
-                    prediction=prediction,
-                    labels=labels,
-                )
-                prediction_finder = label_finder(
-                    prediction=prediction,
-                    labels=labels,
-                )
-                predictions.append(
-                    {
-                        "idx": idx.item(),  # convert tensor to python int
-                        "prompt": prompt,
-                        "prediction": prediction,
-                        "prediction_processed": prediction_processed,
-                        "prediction_finder": prediction_finder,
-                        "label": label,
-                    }
-                )
-        return predictions
+                yield self._format_prediction(idx, prompt, label, prediction, labels)
 
-    def _predict(self, sample) -> List[str]:
-        prediction: List[str] = []
-        if self.use_inference_client:
-            has_output = False
-            while not has_output:
-                try:
-                    prediction: List[str] = [
-                        self.inference_client.text_generation(
-                            sample["prompt"][0], **self.generation_kwargs
-                        )
-                    ]
-                except Exception:
-                    time.sleep(2)
-                    continue
-                has_output = True
+    def _process_samples_pipeline(
+        self,
+        task_data: List[Dict[str, Union[str, int]]],
+        labels: List[str],
+        batch_size: int,
+    ) -> Iterator[Dict[str, Any]]:
+        """Predict the samples with the local pipeline.
+
+        The pipeline gets all the prompts of the task at once, so it tokenizes the next batches
+        in its own DataLoader while the current batch is generated.
+
+        Args:
+            task_data (List[Dict[str, Union[str, int]]]): Samples with idx, prompt and label
+            labels (List[str]): Labels of the task
+            batch_size (int): Number of prompts generated together
+
+        Yields:
+            Dict[str, Any]: Prediction for each sample, as soon as it is generated
+        """
+        outputs = self.llm(
+            KeyDataset(task_data, "prompt"),
+            batch_size=batch_size,
+            num_workers=self._num_workers(),
+        )
+        for sample, output in zip(task_data, tqdm(outputs, total=len(task_data))):
+            prediction: str = output[0]["generated_text"]
+            yield self._format_prediction(
+                sample["idx"], sample["prompt"], sample["label"], prediction, labels
+            )
 
-        else:
-            # Predict
-            output: List[List[Dict[str, str]]] = self.llm(sample["prompt"])
-            # Select the generated output
-            prediction: List[str] = [item[0]["generated_text"] for item in output]
-            # Remove the prompt from the output
-            prediction: List[str] = [
-                pred.replace(prompt, "")
-                for pred, prompt in zip(prediction, sample["prompt"])
-            ]
+    def _process_samples_vllm(
+        self,
+        task_data: List[Dict[str, Union[str, int]]],
+        labels: List[str],
+    ) -> List[Dict[str, Any]]:
+        """Predict the samples with vLLM.
+
+        vLLM gets all the prompts of the task in one call and schedules them itself,
+        and it returns only the generated text.
+
+        Args:
+            task_data (List[Dict[str, Union[str, int]]]): Samples with idx, prompt and label
+            labels (List[str]): Labels of the task
+
+        Returns:
+            List[Dict[str, Any]]: Predictions for the samples
+        """
+        outputs = self.llm.generate(
+            [sample["prompt"] for sample in task_data], self.sampling_params
+        )
+        return [
+            self._format_prediction(
+                sample["idx"],
+                sample["prompt"],
+                sample["label"],
+                output.outputs[0].text,
+                labels,
+            )
+            for sample, output in zip(task_data, outputs)
+        ]
+
+    def _format_prediction(
+        self, idx: int, prompt: str, label: str, prediction: str, labels: List[str]
+    ) -> Dict[str, Any]:
+        """Collect a prediction together with the labels found in it.
+
+        Args:
+            idx (int): Index of the sample
+            prompt (str): Prompt of the sample
+            label (str): True label of the sample
+            prediction (str): Generated output
+            labels (List[str]): Labels of the task
+
+        Returns:
+            Dict[str, Any]: The prediction record
+        """
+        return {
+            "idx": idx,
+            "prompt": prompt,
+            "prediction": prediction,
+            "prediction_processed": label_check(
+                prediction=prediction,
+                labels=labels,
+            ),
+            "prediction_finder": label_finder(
+                prediction=prediction,
+                labels=labels,
+            ),
+            "label": label,
+        }
+
+    def _predict(self, sample) -> List[str]:
+        # The requests are network bound, so the batch is sent concurrently
+        with ThreadPoolExecutor(max_workers=len(sample["prompt"])) as executor:
+            prediction: List[str] = list(
+                executor.map(self._text_generation, sample["prompt"])
+            )
 
         return prediction
 
+    def _text_generation(self, prompt: str) -> str:
+        """Generate the output for a prompt with the inference client, backing off on transient errors."""
+        return call_with_retries(
+            self.inference_client.text_generation, prompt, **self.generation_kwargs
+        )
+
     # def _prepare_social_dim_test_data(
     #     self,
     # ) -> List[Dict[str, Union[str, int, List[str]]]]:
@@ -261,154 +533,197 @@ class Evaluator:
     #     # Return a list of all the values in the dictionary
     #     return list(test_data_formatted.values())
 
+    def _load_socket_task(self, task: str) -> Dataset:
+        """Load the test split of a SOCKET task, once per evaluator.
+
+        Args:
+            task (str): SOCKET task
+
+        Returns:
+            Dataset: Test split of the task
+        """
+        if task not in self._task_datasets:
+            self._task_datasets[task] = load_dataset(
+                "Blablablab/SOCKET",
+                task,
+                split="test",  # trust_remote_code=True
+            )
+        return self._task_datasets[task]
+
     def _prepare_socket_test_data(
         self, task: str
     ) -> List[Dict[str, Union[str, int, List[str]]]]:
-        test_data_formatted: List[Dict[str, str]] = []
-
-        dataset: Dataset = load_dataset(
-            "Blablablab/SOCKET",
-            task,
-            split="test",  # trust_remote_code=True
-        )
-        dataset.cleanup_cache_files()
+        dataset: Dataset = self._load_socket_task(task)
         # if length is more than 2000, randomly sample 2000
         if len(dataset) > 2000:
-            dataset = dataset.shuffle(seed=42).select(range(2000))
+            dataset = select_random_rows(dataset, 2000, seed=42)
 
         if self.is_instruction:
             prompt = self.instructions_prompt_cls
             # get all instructions from self.instructions where task == task
-            task_instructions = (
+            task_instructions = select_random_rows(
                 self.instructions.filter(
                     lambda example: example["task"] == task
-                )  # get all instructions where task == task
-                .shuffle(seed=42)  # shuffle the dataset
-                .select(range(len(dataset)))  # select the same length as the dataset
+                ),  # get all instructions where task == task
+                len(dataset),  # select the same length as the dataset
+                seed=42,
             )
         else:
-            # Get all the socket prompts with type CLS
-            prompt = self.socket_prompts[self.socket_prompts["task"] == task][
-                "question"
-            ].iloc[0]
-
-            # Get the knowledge of the labels
-            # check if knowledge is a column in the dataframe
-            knowledge = (
-                self.socket_prompts[self.socket_prompts["task"] == task][
-                    "knowledge"
-                ].iloc[0]
-                if "knowledge" in self.socket_prompts.columns
-                else pd.NA
-            )
-            knowledge = "" if pd.isna(knowledge) else knowledge
+            prompt = self._prompt_by_task[task]
+            knowledge = self._knowledge_by_task.get(task, "")
 
         labels: List[str] = dataset.features["label"].names
-        labels_formatted = [f'"{label}"' for label in labels]
-        labels_mapping: Dict[int, str] = {i: label for i, label in enumerate(labels)}
-
-        for idx, sample in enumerate(dataset):
-            test_data_formatted.append(
-                {
-                    "idx": idx,
-                    "prompt": (
-                        self._prompt_socket(sample, prompt, labels_formatted, knowledge)
-                        if not self.is_instruction
-                        else self._prompt_socket_instructions(
-                            sample,
-                            prompt,
-                            task_instructions[idx]["instruction"],
-                            labels_formatted,
-                        )
-                    ),
-                    "label": labels_mapping[sample["label"]],
-                }
+        # The label list and the system message are the same for every sample of the task
+        label_list = ", ".join(f'"{label}"' for label in labels)
+        if self.is_instruction:
+            system_content = self._socket_system_content()
+        else:
+            system_content = self._socket_system_content(
+                f"You have the following knowledge about task-specific labels: {knowledge}"
+                if knowledge != ""
+                else ""
+            )
+
+        # Read whole columns at once instead of decoding the Arrow table row by row
+        texts: List[str] = dataset["text"]
+        if self.is_instruction:
+            prompts: List[str] = [
+                self._prompt_socket_instructions(
+                    text, prompt, instruction, label_list, system_content
+                )
+                for text, instruction in zip(texts, task_instructions["instruction"])
+            ]
+        else:
+            render_prompt = self._compile_prompt(
+                lambda text: self._prompt_socket(
+                    text, prompt, label_list, system_content
+                ),
+                texts[0] if texts else "",
             )
+            prompts = [render_prompt(text) for text in texts]
+
+        test_data_formatted = [
+            {"idx": idx, "prompt": sample_prompt, "label": labels[label]}
+            for idx, (sample_prompt, label) in enumerate(zip(prompts, dataset["label"]))
+        ]
 
         return test_data_formatted, labels
 
+    def _compile_prompt(
+        self, render_prompt: Callable[[str], str], sample_text: str
+    ) -> Callable[[str], str]:
+        """Render the chat template of a task once, and fill in the text of each sample.
+
+        The prompt is rendered with a placeholder for the text, and split around it,
+        so a sample only costs a string concatenation instead of a Jinja render.
+        The chat templates trim the message content, so empty texts and texts with leading
+        or trailing whitespace are rendered in full. If the split does not reproduce the full render
+        of the sample text, every prompt is rendered in full.
+
+        Args:
+            render_prompt (Callable[[str], str]): Renders the full prompt for a text
+            sample_text (str): Text used to check the compiled prompt
+
+        Returns:
+            Callable[[str], str]: Function from the text of a sample to its prompt
+        """
+        placeholder = "\x00text\x00"
+        parts = render_prompt(placeholder).split(placeholder)
+        if len(parts) != 2:
+            return render_prompt
+        prefix, suffix = parts
+
+        def fill_prompt(text: str) -> str:
+            if not text or text != text.strip():
+                return render_prompt(text)
+            return prefix + text + suffix
+
+        if fill_prompt(sample_text) != render_prompt(sample_text):
+            return render_prompt
+        return fill_prompt
+
+    def _socket_system_content(self, prompt_prefix: str = "") -> str:
+        """Render the content of the system message once for a task.
+
+        Args:
+            prompt_prefix (str, optional): Task specific text added to the system message. Defaults to "".
+
+        Returns:
+            str: Content of the system message
+        """
+        chat: List[Dict[str, str]] = self.chat_config.get_chat_template()
+        return chat[0]["content"].format(prompt_prefix=prompt_prefix)
+
     def _prompt_socket(
         self,
-        sample: Dict[str, str],
+        text: str,
         prompt: str,
-        labels: List[str],
-        knowledge: str = "",
+        label_list: str,
+        system_content: str,
     ) -> str:
-        chat: List[Dict[str, str]] = self.chat_config.get_chat_template(
-            "system" if "llama" in self.model_id else "user"
-        )  # A bit too hardcoded, but I assume we on
-
-        chat[0]["content"] = chat[0]["content"].format(
-            prompt_prefix=(
-                f"You have the following knowledge about task-specific labels: {knowledge}"
-                if knowledge != ""
-                else ""
-            )
-        )
-
         task_prompt = (
             prompt.format(
-                text=sample["text"],
+                text=text,
             )
-            + f" You can choose from the following labels: {', '.join(labels)}\nAnswer:"
+            + f" You can choose from the following labels: {label_list}\nAnswer:"
         )
 
-        if "llama" in self.model_id:
-            chat.append(
-                {
-                    "role": "user",
-                    "content": task_prompt,
-                }
-            )
-        else:
-            chat[0] = {
-                "role": "user",
-                "content": f"{chat[0]['content']} {task_prompt}",  # Gemma is not trained with a system prompt
-            }
-
-        return self.tokenizer.apply_chat_template(
-            chat, tokenize=False, add_generation_prompt=True
-        )
+        return self._apply_chat_template(task_prompt, system_content)
 
     def _prompt_socket_instructions(
-        self, sample: Dict[str, str], prompt: str, instruction: str, labels: List[str]
+        self,
+        text: str,
+        prompt: str,
+        instruction: str,
+        label_list: str,
+        system_content: str,
     ) -> str:
-        chat: List[Dict[str, str]] = self.chat_config.get_chat_template(
-            "system" if "llama" in self.model_id else "user"
-        )  # A bit too hardcoded, but I assume we on
-
-        chat[0]["content"] = chat[0]["content"].format(prompt_prefix="")
-
         task_prompt: str = prompt.format(
             instruction=instruction,
-            text=sample["text"],
-            label_list=", ".join(labels),
+            text=text,
+            label_list=label_list,
             label="",
         )
 
-        if "llama" in self.model_id:
-            chat.append(
-                {
-                    "role": "user",
-                    "content": task_prompt,
-                }
-            )
-        else:
-            chat[0] = {
-                "role": "user",
-                "content": f"{chat[0]['content']} {task_prompt}",  # Gemma is not trained with a system prompt
-            }
+        return self._apply_chat_template(task_prompt, system_content)
 
+    def _apply_chat_template(self, task_prompt: str, system_content: str) -> str:
+        """Apply the chat template to the task prompt and the system message.
+
+        Args:
+            task_prompt (str): The user part of the prompt
+            system_content (str): Content of the system message
+
+        Returns:
+            str: Prompt with the chat template applied
+        """
         return self.tokenizer.apply_chat_template(
-            chat, tokenize=False, add_generation_prompt=True
+            self._build_chat(task_prompt, system_content),
+            tokenize=False,
+            add_generation_prompt=True,
         )
 
+    def _build_chat_system(
+        self, task_prompt: str, system_content: str
+    ) -> List[Dict[str, str]]:
+        """Build the chat with a system message, as Llama is trained with."""
+        return [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": task_prompt},
+        ]
+
+    def _build_chat_user(
+        self, task_prompt: str, system_content: str
+    ) -> List[Dict[str, str]]:
+        """Build the chat with the system message in the user turn, as Gemma is not trained with a system prompt."""
+        return [{"role": "user", "content": f"{system_content} {task_prompt}"}]
+
     def collate_fn(
         self, batch: List[Dict[str, Union[str, int, List[str]]]]
-    ) -> Dict[str, Union[torch.Tensor, List[Union[str, int, List[str]]]]]:
+    ) -> Dict[str, List[Union[str, int, List[str]]]]:
         """Collate function for the DataLoader to handle labels list."""
         return {
-            "idx": torch.tensor([d["idx"] for d in batch]),
+            "idx": [d["idx"] for d in batch],
             "prompt": [d["prompt"] for d in batch],
             "label": [d["label"] for d in batch],
         }
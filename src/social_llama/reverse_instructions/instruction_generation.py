@@ -1,12 +1,14 @@
 """Generate reverse instructions for the socket benchmark."""
 
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
+import asyncio
+import json
+import time
+from collections import Counter
 
 import pandas as pd
 from datasets import load_dataset
+from openai import AsyncOpenAI
 from openai import OpenAI
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from social_llama.config import DATA_DIR_EVALUATION_SOCKET
@@ -15,7 +17,9 @@ from social_llama.reverse_instructions.instruction_configs import (
     ReverseInstructionsPrompts,
 )
 from social_llama.reverse_instructions.utils import calculate_total_costs_from_nested
+from social_llama.utils import read_jsonl
 from social_llama.utils import save_json
+from social_llama.utils import select_random_rows
 
 
 # Get all the tasks
@@ -26,6 +30,9 @@ socket_prompts: pd.DataFrame = pd.read_csv(
 # Get all classification tasks
 start_index = 5  # Specify the start index
 stop_index = 10  # Specify the stop index
+# Generate through the OpenAI Batch API (half price, results within 24h)
+use_batch_api = False
+max_concurrent_requests = 100  # Adjust based on your rate limits
 cls_tasks = socket_prompts[socket_prompts["type"] == "CLS"][start_index:stop_index]
 
 task_data = {}
@@ -47,13 +54,13 @@ for task in tqdm(cls_tasks["task"].unique(), desc="Load and sample data"):
 
     # Sample 2000 examples from the 'train' split of the dataset
     if len(dataset["train"]) > select_size:
-        dataset["train"] = dataset["train"].shuffle(seed=42).select(range(select_size))
+        dataset["train"] = select_random_rows(dataset["train"], select_size, seed=42)
 
     # Sample 10% of the 'train' split size from the other splits
     sample_size = len(dataset["train"]) // 10
     for split in dataset.keys():
         if split != "train" and len(dataset[split]) > sample_size:
-            dataset[split] = dataset[split].shuffle(seed=42).select(range(sample_size))
+            dataset[split] = select_random_rows(dataset[split], sample_size, seed=42)
 
     # Store the dataset in the dictionary
     task_data[task] = dataset
@@ -70,25 +77,32 @@ client = OpenAI()
 
 
 # Function to process each sample
-def process_sample(
-    sample, labels_mapping, labels, system_prompt, reverse_instructions_prompts, client
+async def process_sample(
+    sample,
+    labels_mapping,
+    labels,
+    system_prompt,
+    reverse_instructions_prompts,
+    async_client,
+    semaphore,
 ):
     """Process each sample to generate reverse instructions."""
-    text = sample["text"][0]
-    label = labels_mapping[sample["label"].item()]
+    text = sample["text"]
+    label = labels_mapping[sample["label"]]
 
     sample_reverse_instruction_prompt = reverse_instructions_prompts.format(
         text=text, label_list=labels, label=label
     )
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": sample_reverse_instruction_prompt},
-            ],
-        )
+        async with semaphore:
+            response = await async_client.chat.completions.create(
+                model="gpt-3.5-turbo-0125",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": sample_reverse_instruction_prompt},
+                ],
+            )
     except Exception as e:
         return {
             "text": text,
@@ -111,46 +125,194 @@ def process_sample(
     }
 
 
+async def generate_concurrently(task, dataset):
+    """Generate the reverse instructions of all splits of a task with concurrent requests.
+
+    The requests are network bound, so they run on one event loop,
+    with a semaphore capping the number of requests in flight.
+    Every finished sample is written to a JSON lines file per split right away,
+    so an interrupted run continues where it stopped, retrying the failed requests.
+    """
+    task_data_reverse_instructions = {}
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    # The client is created per event loop, as its connections are bound to the loop
+    async with AsyncOpenAI() as async_client:
+        for split, data in tqdm(dataset.items(), desc=f"Task: {task}", unit="split"):
+            labels = data.features["label"].names
+            labels_mapping = {i: label for i, label in enumerate(labels)}
+
+            jsonl_path = DATA_DIR_REVERSE_INSTRUCTIONS / f"{task}_{split}.jsonl"
+            finished = [
+                sample_output
+                for sample_output in read_jsonl(jsonl_path)
+                if not sample_output["reverse_instruction"].startswith("Failed.")
+            ]
+            if finished:
+                task_data_reverse_instructions[split] = list(finished)
+
+            # Skip the samples that were finished in an earlier run
+            finished_counts = Counter(
+                (sample_output["text"], sample_output["label"])
+                for sample_output in finished
+            )
+            pending = []
+            for sample in data:
+                key = (sample["text"], labels_mapping[sample["label"]])
+                if finished_counts[key] > 0:
+                    finished_counts[key] -= 1
+                else:
+                    pending.append(sample)
+
+            jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(jsonl_path, "w", encoding="utf-8") as jsonl_f:
+                for sample_output in finished:
+                    jsonl_f.write(json.dumps(sample_output, ensure_ascii=False) + "\n")
+
+                requests = [
+                    process_sample(
+                        sample,
+                        labels_mapping,
+                        labels,
+                        system_prompt,
+                        reverse_instructions_prompts,
+                        async_client,
+                        semaphore,
+                    )
+                    for sample in pending
+                ]
+
+                for request in tqdm(
+                    asyncio.as_completed(requests),
+                    total=len(requests),
+                    desc=f"Processing {split}",
+                ):
+                    sample_output = await request
+                    jsonl_f.write(json.dumps(sample_output, ensure_ascii=False) + "\n")
+                    jsonl_f.flush()
+                    task_data_reverse_instructions.setdefault(split, []).append(
+                        sample_output
+                    )
+
+    return task_data_reverse_instructions
+
+
+def run_batch(requests, task):
+    """Run chat completion requests through the OpenAI Batch API and return the responses by custom_id."""
+    batch_input_path = DATA_DIR_REVERSE_INSTRUCTIONS / f"{task}_batch_input.jsonl"
+    batch_input_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(batch_input_path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+    with open(batch_input_path, "rb") as f:
+        batch_input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+    # Poll until the batch is done
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(60)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.output_file_id is None:
+        raise ValueError(f"Batch {batch.id} for {task} ended as {batch.status}.")
+
+    responses = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        output = json.loads(line)
+        responses[output["custom_id"]] = output["response"]
+    return responses
+
+
+def generate_with_batch_api(task, dataset):
+    """Generate the reverse instructions of all splits of a task in a single batch."""
+    requests = []
+    samples = {}
+    for split, data in dataset.items():
+        labels = data.features["label"].names
+        for i, (text, label_id) in enumerate(zip(data["text"], data["label"])):
+            label = labels[label_id]
+            sample_reverse_instruction_prompt = reverse_instructions_prompts.format(
+                text=text, label_list=labels, label=label
+            )
+            custom_id = f"{task}-{split}-{i}"
+            samples[custom_id] = (split, text, label, sample_reverse_instruction_prompt)
+            requests.append(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": "gpt-3.5-turbo-0125",
+                        "messages": [
+                            {"role": "system", "content": system_prompt},
+                            {
+                                "role": "user",
+                                "content": sample_reverse_instruction_prompt,
+                            },
+                        ],
+                    },
+                }
+            )
+
+    responses = run_batch(requests, task)
+
+    # Reassemble the outputs per split, in the same format as process_sample
+    task_data_reverse_instructions = {}
+    for custom_id, (split, text, label, prompt) in samples.items():
+        response = responses.get(custom_id)
+        if response is None or response["status_code"] != 200:
+            sample_output = {
+                "text": text,
+                "label": label,
+                "prompt": prompt,
+                "reverse_instruction": f"Failed. Error: {response}",
+                "metadata": {
+                    "created": "",
+                    "model": "",
+                    "usage": {"completion_tokens": 0},
+                },
+            }
+        else:
+            body = response["body"]
+            sample_output = {
+                "text": text,
+                "label": label,
+                "prompt": prompt,
+                "reverse_instruction": body["choices"][0]["message"]["content"],
+                "metadata": {
+                    "created": body["created"],
+                    "model": body["model"],
+                    "usage": body["usage"],
+                },
+            }
+        task_data_reverse_instructions.setdefault(split, []).append(sample_output)
+
+    return task_data_reverse_instructions
+
+
 for task, dataset in tqdm(
     task_data.items(),
     desc="Generate reverse instructions",
     total=len(task_data),
     unit="task:",
 ):
-    task_data_reverse_instructions = {}
-
-    for split, data in tqdm(dataset.items(), desc=f"Task: {task}", unit="split"):
-        labels = data.features["label"].names
-        labels_mapping = {i: label for i, label in enumerate(labels)}
-
-        with ThreadPoolExecutor(
-            max_workers=30
-        ) as executor:  # Adjust max_workers based on your environment
-            future_to_sample = {
-                executor.submit(
-                    process_sample,
-                    sample,
-                    labels_mapping,
-                    labels,
-                    system_prompt,
-                    reverse_instructions_prompts,
-                    client,
-                ): sample
-                for sample in DataLoader(data, batch_size=1)
-            }
-
-            for future in tqdm(
-                as_completed(future_to_sample),
-                total=len(future_to_sample),
-                desc=f"Processing {split}",
-            ):
-                sample_output = future.result()
-                task_data_reverse_instructions.setdefault(split, []).append(
-                    sample_output
-                )
+    task_data_reverse_instructions = (
+        generate_with_batch_api(task, dataset)
+        if use_batch_api
+        else asyncio.run(generate_concurrently(task, dataset))
+    )
 
     price_per_million_completion_tokens = 1.5
     price_per_million_prompt_tokens = 0.5
+    if use_batch_api:
+        # The Batch API is billed at half price
+        price_per_million_completion_tokens /= 2
+        price_per_million_prompt_tokens /= 2
 
     generation_costs = calculate_total_costs_from_nested(
         [task_data_reverse_instructions],
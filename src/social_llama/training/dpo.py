@@ -1,21 +1,31 @@
 """Fine-tuning script for DPO training."""
 
+import logging
 import os
 from dataclasses import dataclass
 from dataclasses import field
+from typing import Dict
+from typing import List
 from typing import Optional
 
 import torch
+import torch.distributed as dist
+from datasets import DatasetDict
+from datasets import load_from_disk
 from dotenv import load_dotenv
 
 # from peft import AutoPeftModelForCausalLM
 from peft import LoraConfig
 from peft import PeftModel
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.nn.parallel import DistributedDataParallel
 from transformers import AutoModelForCausalLM
 from transformers import AutoTokenizer
 from transformers import BitsAndBytesConfig
 from transformers import HfArgumentParser
+from transformers import TrainerCallback
 from transformers import TrainingArguments
+from transformers.utils import is_flash_attn_2_available
 from trl import DPOTrainer
 
 from social_llama.data_processing.combine import Combined
@@ -26,6 +36,61 @@ from social_llama.data_processing.socket import Socket
 
 load_dotenv()
 
+# The Llama layers adapted by LoRA for each lora_scope
+LLAMA_LORA_TARGET_MODULES: Dict[str, List[str]] = {
+    "qv": ["q_proj", "v_proj"],
+    "attn": ["q_proj", "k_proj", "v_proj", "o_proj"],
+    "all": [
+        "q_proj",
+        "k_proj",
+        "v_proj",
+        "o_proj",
+        "gate_proj",
+        "up_proj",
+        "down_proj",
+    ],
+}
+
+
+class DDPTunedDPOTrainer(DPOTrainer):
+    """DPOTrainer with DDP tuned for a fixed set of trainable LoRA parameters."""
+
+    def _wrap_model(self, model, training=True, dataloader=None):
+        """Wrap the model, and let DDP reuse the gradients as allreduce buckets with a static graph.
+
+        gradient_as_bucket_view avoids copying the gradients into the allreduce buckets,
+        and static_graph lets DDP plan the communication once, as the same parameters are used every step.
+        """
+        model = super()._wrap_model(model, training=training, dataloader=dataloader)
+        if self.accelerator.ddp_handler is not None:
+            self.accelerator.ddp_handler.gradient_as_bucket_view = True
+            self.accelerator.ddp_handler.static_graph = True
+        return model
+
+    def tokenize_row(self, feature, model=None):
+        """Tokenize a row, passing through rows already tokenized by an earlier run."""
+        if "chosen_input_ids" in feature:
+            return feature
+        return super().tokenize_row(feature, model=model)
+
+
+class FP16CompressHookCallback(TrainerCallback):
+    """Compress the DDP gradients to fp16 for the allreduce, halving the bytes sent between nodes."""
+
+    def __init__(self, trainer: DPOTrainer) -> None:
+        """Initialize the FP16CompressHookCallback.
+
+        Args:
+            trainer (DPOTrainer): Trainer whose DDP-wrapped model gets the hook
+        """
+        self.trainer = trainer
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        """Register the hook, once the model is wrapped in DDP and before the first step."""
+        model = self.trainer.model_wrapped
+        if dist.is_initialized() and isinstance(model, DistributedDataParallel):
+            model.register_comm_hook(state=None, hook=default_hooks.fp16_compress_hook)
+
 
 # Define and parse arguments.
 @dataclass
@@ -39,7 +104,9 @@ class ScriptArguments:
     # training parameters
     model_name_or_path: Optional[str] = field(
         default="sft/Meta-Llama-3-8B-Instruct_socket_1_epoch/final_checkpoint",
-        metadata={"help": "the location of the SFT model name or path"},
+        metadata={
+            "help": "the location of the SFT model name or path, set it to base_model to train a new adapter"
+        },
     )
     base_model: Optional[str] = field(
         default="meta-llama/Meta-Llama-3-8B-Instruct",
@@ -66,7 +133,7 @@ class ScriptArguments:
         default=0.05, metadata={"help": "the weight decay"}
     )
     optimizer_type: Optional[str] = field(
-        default="paged_adamw_32bit", metadata={"help": "the optimizer type"}
+        default="paged_adamw_8bit", metadata={"help": "the optimizer type"}
     )
 
     per_device_train_batch_size: Optional[int] = field(
@@ -81,6 +148,10 @@ class ScriptArguments:
     gradient_checkpointing: Optional[bool] = field(
         default=True, metadata={"help": "whether to use gradient checkpointing"}
     )
+    torch_compile: Optional[bool] = field(
+        default=False,
+        metadata={"help": "whether to compile the policy model with torch.compile"},
+    )
 
     lora_alpha: Optional[float] = field(
         default=16, metadata={"help": "the lora alpha parameter"}
@@ -89,6 +160,13 @@ class ScriptArguments:
         default=0.05, metadata={"help": "the lora dropout parameter"}
     )
     lora_r: Optional[int] = field(default=8, metadata={"help": "the lora r parameter"})
+    lora_scope: Optional[str] = field(
+        default="qv",
+        metadata={
+            "help": "the Llama layers to adapt: 'qv' (query and value), 'attn' (all attention projections) or 'all' (attention and MLP). "
+            "Only used when training a new adapter, an SFT adapter keeps the layers it was trained on"
+        },
+    )
 
     max_prompt_length: Optional[int] = field(
         default=2048, metadata={"help": "the maximum prompt length"}
@@ -115,6 +193,13 @@ class ScriptArguments:
         default=1, metadata={"help": "the logging frequency"}
     )
 
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "the directory to cache the tokenized datasets in, so later runs on the same data skip the tokenization"
+        },
+    )
+
     # instrumentation
     sanity_check: Optional[bool] = field(
         default=False, metadata={"help": "only train on 1000 samples"}
@@ -140,6 +225,10 @@ class ScriptArguments:
 if __name__ == "__main__":
     parser = HfArgumentParser(ScriptArguments)
     script_args = parser.parse_args_into_dataclasses()[0]
+    if script_args.lora_scope not in LLAMA_LORA_TARGET_MODULES:
+        raise ValueError(
+            f"lora_scope must be one of {list(LLAMA_LORA_TARGET_MODULES)}, got {script_args.lora_scope}."
+        )
 
     # Load the base model.
     bnb_config = BitsAndBytesConfig(
@@ -147,11 +236,14 @@ if __name__ == "__main__":
         # load_in_8bit=True,
         # llm_int8_threshold=6.0,
         # llm_int8_has_fp16_weight=False,
-        # bnb_4bit_compute_dtype=torch.bfloat16,
-        # bnb_4bit_use_double_quant=True,
-        # bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_type="nf4",
     )
 
+    # FlashAttention-2 avoids materializing the attention matrix, fall back to SDPA without flash-attn
+    attn_implementation = "flash_attention_2" if is_flash_attn_2_available() else "sdpa"
+
     # 1. load a pretrained model
     # model = AutoPeftModelForCausalLM.from_pretrained(
     #     script_args.model_name_or_path,
@@ -167,16 +259,8 @@ if __name__ == "__main__":
         script_args.base_model,
         # load_in_4bit=True,
         quantization_config=bnb_config,
-        # attn_implementation="flash_attention_2",
-        torch_dtype=torch.float32,
-        device_map="auto",
-    )
-    model_ref = AutoModelForCausalLM.from_pretrained(
-        script_args.base_model,
-        # load_in_4bit=True,
-        quantization_config=bnb_config,
-        # attn_implementation="flash_attention_2",
-        torch_dtype=torch.float32,
+        attn_implementation=attn_implementation,
+        torch_dtype=torch.bfloat16,
         device_map="auto",
     )
     model.config.use_cache = False
@@ -190,31 +274,25 @@ if __name__ == "__main__":
             name for name, buffer in model.named_buffers() if buffer.dtype == torch.bool
         ]
 
-    # Load the adapter.
-    model = PeftModel.from_pretrained(
-        model,
-        script_args.model_name_or_path,
-        is_trainable=True,
-        # adapter_name="train",
-    )
-    # Load the adapter a second time, with a different name, which will be our reference model.
-    # model.load_adapter(script_args.model_name_or_path, adapter_name="reference")
+    # Without an SFT adapter, DPOTrainer creates a new adapter from the peft_config below
+    load_sft_adapter = script_args.model_name_or_path != script_args.base_model
+    if load_sft_adapter and script_args.lora_scope != ScriptArguments.lora_scope:
+        logging.warning(
+            f"lora_scope={script_args.lora_scope} is ignored, "
+            f"the SFT adapter {script_args.model_name_or_path} keeps the layers it was trained on."
+        )
+    if load_sft_adapter:
+        # Load the adapter.
+        model = PeftModel.from_pretrained(
+            model,
+            script_args.model_name_or_path,
+            is_trainable=True,
+            adapter_name="train",
+        )
+        # Load the adapter a second time, with a different name, which will be our reference model.
+        # The reference model shares the 4-bit base weights, instead of loading a second copy of the base model.
+        model.load_adapter(script_args.model_name_or_path, adapter_name="reference")
 
-    model_ref = PeftModel.from_pretrained(
-        model_ref,
-        script_args.model_name_or_path,
-        # adapter_name="train",
-    )
-
-    # model_ref = AutoPeftModelForCausalLM.from_pretrained(
-    #     script_args.model_name_or_path,
-    #     low_cpu_mem_usage=True,
-    #     torch_dtype=torch.float32,
-    #     load_in_4bit=False,
-    #     load_in_8bit=True,
-    #     # device_map={"": Accelerator().local_process_index},
-    #     # device_map={"":torch.cuda.current_device()}
-    # )
     if script_args.dataset_name == "social-dimensions":
         dataset = SocialDimensions(task="zero-shot", model=script_args.base_model)
     elif script_args.dataset_name == "socket":
@@ -227,6 +305,24 @@ if __name__ == "__main__":
     dataset.get_data()
     train_dataset, eval_dataset = dataset.preprocess_dpo()
 
+    # The fingerprints change with the data and the prompt formatting,
+    # so edited prompts or a new dataset revision are tokenized again instead of reusing stale rows
+    tokenized_cache = (
+        os.path.join(
+            script_args.tokenized_cache_dir,
+            f"{script_args.dataset_name}_{script_args.base_model.split('/')[-1]}"
+            f"_{script_args.max_prompt_length}_{script_args.max_length}"
+            f"_{train_dataset._fingerprint}_{eval_dataset._fingerprint}",
+        )
+        if script_args.tokenized_cache_dir
+        else None
+    )
+    use_tokenized_cache = tokenized_cache is not None and os.path.isdir(tokenized_cache)
+    if use_tokenized_cache:
+        tokenized_datasets = load_from_disk(tokenized_cache)
+        train_dataset = tokenized_datasets["train"]
+        eval_dataset = tokenized_datasets["eval"]
+
     tokenizer = AutoTokenizer.from_pretrained(
         script_args.base_model, trust_remote_code=True
     )
@@ -244,6 +340,7 @@ if __name__ == "__main__":
         save_steps=script_args.save_steps,
         gradient_accumulation_steps=script_args.gradient_accumulation_steps,
         gradient_checkpointing=script_args.gradient_checkpointing,
+        torch_compile=script_args.torch_compile,
         learning_rate=script_args.learning_rate,
         evaluation_strategy="steps",
         eval_steps=script_args.eval_steps,
@@ -255,6 +352,8 @@ if __name__ == "__main__":
         # fp16=False,
         bf16=True,
         remove_unused_columns=False,
+        # Every trainable parameter gets a gradient each step, so DDP does not need to search for unused ones
+        ddp_find_unused_parameters=False,
         run_name=f"dpo_{MODEL_NAME}",
     )
 
@@ -262,45 +361,53 @@ if __name__ == "__main__":
         r=script_args.lora_r,
         lora_alpha=script_args.lora_alpha,
         lora_dropout=script_args.lora_dropout,
-        target_modules=[
-            "q_proj",
-            "v_proj",
-            "k_proj",
-            "out_proj",
-            "fc_in",
-            "fc_out",
-            "wte",
-        ],
-        # if "llama" in script_args.base_model
-        # else [
-        #     "q_proj",
-        #     "o_proj",
-        #     "k_proj",
-        #     "v_proj",
-        #     "gate_proj",
-        #     "up_proj",
-        #     "down_proj",
-        # ],
+        target_modules=(
+            LLAMA_LORA_TARGET_MODULES[script_args.lora_scope]
+            if "llama" in script_args.base_model
+            else [
+                "q_proj",
+                "v_proj",
+                "k_proj",
+                "out_proj",
+                "fc_in",
+                "fc_out",
+                "wte",
+            ]
+        ),
         bias="none",
         task_type="CAUSAL_LM",
     )
 
     # 5. initialize the DPO trainer
-    dpo_trainer = DPOTrainer(
+    dpo_trainer = DDPTunedDPOTrainer(
         model,
-        model_ref,
+        None,
         args=training_args,
         beta=script_args.beta,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         tokenizer=tokenizer,
-        # peft_config=peft_config,
+        # Passing a peft_config with an adapter already loaded would merge that adapter into the base model
+        peft_config=None if load_sft_adapter else peft_config,
         max_prompt_length=script_args.max_prompt_length,
         max_length=script_args.max_length,
-        # model_adapter_name="train",
-        # ref_adapter_name="reference",
+        # Without named adapters, the reference model is the base model with the adapter disabled
+        model_adapter_name="train" if load_sft_adapter else None,
+        ref_adapter_name="reference" if load_sft_adapter else None,
     )
 
+    if (
+        tokenized_cache is not None
+        and not use_tokenized_cache
+        and dpo_trainer.is_world_process_zero()
+    ):
+        DatasetDict(
+            {"train": dpo_trainer.train_dataset, "eval": dpo_trainer.eval_dataset}
+        ).save_to_disk(tokenized_cache)
+
+    # Only takes effect when training with DDP
+    dpo_trainer.add_callback(FP16CompressHookCallback(dpo_trainer))
+
     # 6. train
     dpo_trainer.train()
     dpo_trainer.save_model(script_args.output_dir)
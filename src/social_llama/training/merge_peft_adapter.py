@@ -5,6 +5,7 @@ from dataclasses import field
 from typing import Optional
 
 import torch
+from huggingface_hub import HfApi
 from peft import PeftConfig
 from peft import PeftModel
 from transformers import AutoModelForCausalLM
@@ -38,11 +39,19 @@ peft_config = PeftConfig.from_pretrained(script_args.adapter_model_name)
 if peft_config.task_type == "SEQ_CLS":
     # peft is for reward model so load sequence classification
     model = AutoModelForSequenceClassification.from_pretrained(
-        script_args.base_model_name, num_labels=1, torch_dtype=torch.bfloat16
+        script_args.base_model_name,
+        num_labels=1,
+        torch_dtype=torch.bfloat16,
+        attn_implementation="sdpa",
+        low_cpu_mem_usage=True,
     )
 else:
     model = AutoModelForCausalLM.from_pretrained(
-        script_args.base_model_name, return_dict=True, torch_dtype=torch.bfloat16
+        script_args.base_model_name,
+        return_dict=True,
+        torch_dtype=torch.bfloat16,
+        attn_implementation="sdpa",
+        low_cpu_mem_usage=True,
     )
 
 tokenizer = AutoTokenizer.from_pretrained(script_args.base_model_name)
@@ -51,10 +60,14 @@ tokenizer = AutoTokenizer.from_pretrained(script_args.base_model_name)
 model = PeftModel.from_pretrained(model, script_args.adapter_model_name)
 model.eval()
 
+# The adapter weights are loaded in fp32, cast them so the merge stays in bf16
+model = model.to(torch.bfloat16)
 model = model.merge_and_unload()
 
-model.save_pretrained(f"{script_args.output_name}")
+model.save_pretrained(f"{script_args.output_name}", max_shard_size="5GB")
 tokenizer.save_pretrained(f"{script_args.output_name}")
-model.push_to_hub(f"{script_args.output_name}", use_temp_dir=False)
 
-tokenizer.push_to_hub(f"{script_args.output_name}", use_temp_dir=False)
+# Upload the model shards and the tokenizer together, in a single commit with parallel file uploads
+api = HfApi()
+repo_id = api.create_repo(script_args.output_name, exist_ok=True).repo_id
+api.upload_folder(repo_id=repo_id, folder_path=f"{script_args.output_name}")
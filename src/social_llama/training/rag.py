@@ -1,23 +1,30 @@
 """Retrieval-Augmented Generation (RAG) system for classification."""
 
+import json
 import logging
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Dict
 from typing import List
+from typing import Tuple
 
 import datasets
+import faiss
+import numpy as np
 import pandas as pd
 import torch
 from dotenv import load_dotenv
 from huggingface_hub import InferenceClient
+from huggingface_hub.errors import ValidationError
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_core.documents import Document
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import AutoTokenizer
 from transformers import pipeline
@@ -27,12 +34,18 @@ from social_llama.config import DATA_DIR_EVALUATION_SOCKET
 from social_llama.config import DATA_DIR_SOCIAL_DIMENSIONS_PROCESSED
 from social_llama.config import DATA_DIR_VECTOR_DB
 from social_llama.evaluation.helper_functions import label_finder
+from social_llama.utils import call_with_retries
+from social_llama.utils import compile_template
+from social_llama.utils import read_jsonl
 from social_llama.utils import save_json
 
 
 load_dotenv()
 datasets.disable_caching()
 
+# Below this many vectors an exact search is fast, and too few to train the IVF-PQ clusters and codebooks
+IVF_PQ_MIN_VECTORS = 256 * 39
+
 
 class RAGClassification:
     """RAG Based classificaiton system."""
@@ -45,8 +58,15 @@ class RAGClassification:
         """Initializes the RAG classification system."""
         self.model_name = model_name
         self.model_name_embedding = model_name_embedding
-        self.model_kwargs: dict = {"device": self._get_device()}
-        self.encode_kwargs: dict = {"normalize_embeddings": True}
+        device = self._get_device()
+        self.model_kwargs: dict = {"device": device}
+        # Embed in fp16 on CUDA, halving the memory traffic and leaving room for larger batches
+        self.use_fp16 = device.type == "cuda"
+        # Larger batches than the default of 32 keep the GPU busy while building the vector database
+        self.encode_kwargs: dict = {
+            "normalize_embeddings": True,
+            "batch_size": 512 if self.use_fp16 else 256,
+        }
 
     def convert_data_to_langchain(self, dataset, is_socket: bool = False):
         """Converts a HuggingFace dataset to a list of langchain documents.
@@ -57,29 +77,35 @@ class RAGClassification:
         Returns:
             docs (list): List of langchain documents.
         """
-        docs = []
+        # Read the columns as plain Python rows, without the torch collation of a DataLoader
         if is_socket:
-            for idx, d in enumerate(DataLoader(dataset["train"])):
-                docs.append(
-                    Document(
-                        page_content=d["text"][0],
-                        metadata={
-                            "idx": idx,
-                            "label": labels_mapping[d["label"].item()],
-                        },
-                    )
+            rows = dataset["train"].select_columns(["text", "label"]).to_list()
+            docs = [
+                Document(
+                    page_content=row["text"],
+                    metadata={
+                        "idx": idx,
+                        "label": labels_mapping[row["label"]],
+                    },
                 )
+                for idx, row in enumerate(rows)
+            ]
         else:
-            for d in DataLoader(dataset["train"]):
-                docs.append(
-                    Document(
-                        page_content=d["text"][0],
-                        metadata={
-                            "idx": d["idx"].item(),
-                            "label": d["response_good"][0],
-                        },
-                    )
+            rows = (
+                dataset["train"]
+                .select_columns(["text", "idx", "response_good"])
+                .to_list()
+            )
+            docs = [
+                Document(
+                    page_content=row["text"],
+                    metadata={
+                        "idx": row["idx"],
+                        "label": row["response_good"],
+                    },
                 )
+                for row in rows
+            ]
         return docs
 
     def make_or_load_vector_db(
@@ -108,7 +134,10 @@ class RAGClassification:
             model_kwargs=self.model_kwargs,  # Pass the model configuration options
             encode_kwargs=self.encode_kwargs,  # Pass the encoding options
         )
+        if self.use_fp16:
+            embeddings.client.half()
 
+        db = None
         # Check if there exist a vector database with a name
         if (
             os.path.exists(str(DATA_DIR_VECTOR_DB / f"{dataset_name}.faiss"))
@@ -116,13 +145,19 @@ class RAGClassification:
         ):
             logging.info(f"Vector database {dataset_name}.faiss exists. Loading...")
             db = FAISS.load_local(
-                str(DATA_DIR_VECTOR_DB / f"{dataset_name}.faiss"), embeddings
+                str(DATA_DIR_VECTOR_DB / f"{dataset_name}.faiss"),
+                embeddings,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
             )
+            # Databases saved with an L2 index give distances, which would be ranked as similarities
+            if db.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                logging.warning(
+                    f"Vector database {dataset_name}.faiss has no inner product index. Remaking..."
+                )
+                db = None
 
-        else:
-            logging.info(
-                f"Vector database {dataset_name}.faiss does not exist. Creating..."
-            )
+        if db is None:
+            logging.info(f"Creating vector database {dataset_name}.faiss...")
             # Create an instance of the RecursiveCharacterTextSplitter class with specific parameters.
             # It splits text into chunks of 1000 characters each with a 150-character overlap.
             text_splitter = RecursiveCharacterTextSplitter(
@@ -132,19 +167,54 @@ class RAGClassification:
             # 'data' holds the text you want to split, split the text into documents using the text splitter.
             docs = text_splitter.split_documents(data)
 
-            db = FAISS.from_documents(docs, embeddings)
-
-            # Change distance strategy to cosine similarity
-            db.distance_strategy = DistanceStrategy.COSINE
+            # Embed all the chunks in one batched call, and build the database from the vectors
+            texts = [doc.page_content for doc in docs]
+            vectors = embeddings.embed_documents(texts)
+            # The embeddings are normalized, so the inner product is the cosine similarity
+            db = FAISS(
+                embeddings,
+                self._build_index(np.asarray(vectors, dtype=np.float32)),
+                InMemoryDocstore(),
+                {},
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+            db.add_embeddings(
+                list(zip(texts, vectors)), metadatas=[doc.metadata for doc in docs]
+            )
 
             # Save the vector database to the specified path
             db.save_local(str(DATA_DIR_VECTOR_DB / f"{dataset_name}.faiss"))
             logging.info(f"Vector database {dataset_name}.faiss created and saved.")
 
+        # Search on the GPU if faiss is built with GPU support, the saved index stays on the CPU
+        if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+            db.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, db.index)
+
         retriever = db.as_retriever(search_kwargs={"k": 5})
 
         return db, retriever
 
+    def _build_index(self, vectors: np.ndarray) -> faiss.Index:
+        """Builds an empty inner product index, trained on the vectors if needed.
+
+        Args:
+            vectors (np.ndarray): Normalized embeddings of the documents.
+
+        Returns:
+            index (faiss.Index): Index to add the vectors to.
+        """
+        dimension = vectors.shape[1]
+        if len(vectors) < IVF_PQ_MIN_VECTORS:
+            return faiss.IndexFlatIP(dimension)
+
+        index = faiss.index_factory(
+            dimension, "IVF256,PQ32", faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vectors)
+        # Search more than one cluster, as the nearest documents can fall in neighbouring clusters
+        faiss.extract_index_ivf(index).nprobe = 16
+        return index
+
     def _get_device(self):
         """Gets the device to use for the model.
 
@@ -234,6 +304,65 @@ class HuggingfaceChatTemplate:
         return self.tokenizer.apply_chat_template(chat, tokenize=False)
 
 
+def make_inference_client(client_path: str) -> InferenceClient:
+    """Creates an inference client with caching disabled.
+
+    Args:
+        client_path (str): Model name or endpoint URL.
+
+    Returns:
+        llm (InferenceClient): Inference client.
+    """
+    llm = InferenceClient(
+        model=client_path,
+        token=os.environ["HUGGINGFACEHUB_API_TOKEN"],
+        timeout=20,
+    )
+    # Disable caching
+    llm.headers["x-use-cache"] = "0"
+    return llm
+
+
+def generate_prediction(
+    llm, prompt: str, use_inference_client: bool
+) -> Tuple[str, float]:
+    """Generates the output for a prompt.
+
+    Args:
+        llm (Union[InferenceClient, Pipeline]): Inference client or text generation pipeline.
+        prompt (str): Prompt to generate from.
+        use_inference_client (bool): Whether llm is an inference client.
+
+    Returns:
+        prediction (str): Generated output, without the prompt, empty if the endpoint rejects the prompt.
+        inference_time (float): Time spent generating, in seconds.
+    """
+    start_time = time.time()
+    if not use_inference_client:
+        # Predict
+        output: List[List[Dict[str, str]]] = llm(prompt)
+        # Select the generated output, and remove the prompt from it
+        prediction: str = output[0]["generated_text"].replace(prompt, "")
+        return prediction, time.time() - start_time
+
+    # Timeouts, rate limits and server errors are retried with the same client
+    try:
+        prediction = call_with_retries(
+            llm.text_generation,
+            prompt,
+            max_delay=30.0,
+            max_new_tokens=250,
+            temperature=0.9,
+            # repetition_penalty=1.2,
+        )
+    except ValidationError as e:
+        # E.g. a prompt with long retrieved documents exceeding the maximum input length,
+        # which fails the same way on every attempt, so the sample gets an empty output
+        logging.info(f"Error: {e}")
+        prediction = ""
+    return prediction, time.time() - start_time
+
+
 # Load the data
 dataset_names = ["social-dimensions"]
 dataset_names = [
@@ -397,13 +526,7 @@ for dataset_name in dataset_names:
             )
         else:
             client_path = model_name
-        llm = InferenceClient(
-            model=client_path,
-            token=os.environ["HUGGINGFACEHUB_API_TOKEN"],
-            timeout=20,
-        )
-        # Disable caching
-        llm.headers["x-use-cache"] = "0"
+        llm = make_inference_client(client_path)
         use_inference_client = True
 
     system_prompt = """You are part of a RAG classification system designed to categorize texts.
@@ -429,15 +552,16 @@ for dataset_name in dataset_names:
         system_prompt=system_prompt,
         task=task,
     )
+    render_prompt = compile_template(template)
 
     # Group by idx and collect labels
     test_data_formatted = {}
 
     # Loop through each JSON object and group by 'idx'
-    for id_, obj in enumerate(DataLoader(dataset_test["train"])):
-        idx = obj["idx"].item() if dataset_name == "social-dimensions" else id_
+    for id_, obj in enumerate(dataset_test["train"].to_list()):
+        idx = obj["idx"] if dataset_name == "social-dimensions" else id_
         response_good = (
-            obj["response_good"][0]
+            obj["response_good"]
             if dataset_name == "social-dimensions"
             else obj["label"]
         )
@@ -447,14 +571,10 @@ for dataset_name in dataset_names:
                 "label": (
                     []
                     if dataset_name == "social-dimensions"
-                    else labels_mapping[response_good.item()]
+                    else labels_mapping[response_good]
                 ),
                 "idx": idx,
-                "text": (
-                    obj["text"][0]
-                    if dataset_name == "social-dimensions"
-                    else obj["text"][0]
-                ),
+                "text": obj["text"],
             }
         else:
             test_data_formatted[idx]["label"].append(response_good)
@@ -462,86 +582,6 @@ for dataset_name in dataset_names:
     # Return a list of all the values in the dictionary
     test_data_formatted = list(test_data_formatted.values())
 
-    predictions = []
-
-    for idx, sample in tqdm(enumerate(test_data_formatted), desc="Predicting"):
-        search_docs_text = db.similarity_search_with_score(
-            sample["text"], k=5, fetch_k=10
-        )
-        # searchDocs_question = db.similarity_search_with_score(question, k=5, fetch_k=25)
-
-        decoded_text = RAG.decode_documents(search_docs_text)
-        # decoded_question = decode_documents(searchDocs_question)
-
-        has_output = False
-
-        # This is need as the LLM client sometimes is just hanging and needs to be reinitialized
-
-        start_time = time.time()
-        while not has_output:
-            if use_inference_client:
-                try:
-                    prediction = llm.text_generation(
-                        template.format(
-                            context=decoded_text,
-                            text=sample["text"],
-                        ),
-                        max_new_tokens=250,
-                        temperature=0.9,
-                        # repetition_penalty=1.2,
-                    )
-                    has_output = True
-
-                except Exception as e:
-                    logging.info(f"Error: {e}")
-
-                    # Delete LLM
-                    del llm
-
-                    logging.info("Reinitializing LLM...")
-                    llm = InferenceClient(
-                        model=client_path,
-                        token=os.environ["HUGGINGFACEHUB_API_TOKEN"],
-                        timeout=20,
-                    )
-                    # Disable caching
-                    llm.headers["x-use-cache"] = "0"
-            else:
-                # Predict
-                output: List[List[Dict[str, str]]] = llm(
-                    template.format(
-                        context=decoded_text,
-                        text=sample["text"],
-                    )
-                )
-                # Select the generated output
-                prediction: str = output[0]["generated_text"]
-                # Remove the prompt from the output
-                prediction: str = prediction.replace(
-                    template.format(
-                        context=decoded_text,
-                        text=sample["text"],
-                    ),
-                    "",
-                )
-                has_output = True
-
-        end_time = time.time()
-
-        label = label_finder(prediction, labels)
-
-        predictions.append(
-            {
-                "idx": idx,
-                "text": sample["text"],
-                "label": sample["label"],
-                "prediction": label,
-                "output": prediction,
-                "documents": decoded_text,
-                "inference_time": end_time - start_time,
-            }
-        )
-
     if is_socket:
         save_path = (
             DATA_DIR_EVALUATION_SOCKET
@@ -552,5 +592,72 @@ for dataset_name in dataset_names:
             DATA_DIR_EVALUATION_SOCIAL_DIMENSIONS / f"{model_name}_predictions_RAG.json"
         )
 
+    # Predictions are written to a JSON lines file as they are made,
+    # so an interrupted run continues with the samples that were not predicted yet
+    checkpoint_path = save_path.with_suffix(".jsonl")
+    predictions = read_jsonl(checkpoint_path)
+    predicted_idx = {prediction["idx"] for prediction in predictions}
+    remaining_samples = [
+        (idx, sample)
+        for idx, sample in enumerate(test_data_formatted)
+        if idx not in predicted_idx
+    ]
+
+    # Embed all the queries in one batched call, and retrieve the documents before generating
+    query_vectors = db.embedding_function.embed_documents(
+        [sample["text"] for _, sample in remaining_samples]
+    )
+    decoded_texts = [
+        RAG.decode_documents(
+            db.similarity_search_with_score_by_vector(query_vector, k=5, fetch_k=10)
+        )
+        for query_vector in tqdm(query_vectors, desc="Retrieving")
+    ]
+    prompts = [
+        render_prompt(context=decoded_text, text=sample["text"])
+        for (_, sample), decoded_text in zip(remaining_samples, decoded_texts)
+    ]
+
+    generate = partial(
+        generate_prediction, llm, use_inference_client=use_inference_client
+    )
+    executor = ThreadPoolExecutor(max_workers=16)
+    # Keep several requests in flight with the inference client, hiding the round trip to the endpoint
+    outputs = (
+        executor.map(generate, prompts)
+        if use_inference_client
+        else map(generate, prompts)
+    )
+
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(checkpoint_path, "a", encoding="utf-8") as checkpoint_file:
+            for (idx, sample), decoded_text, (prediction, inference_time) in tqdm(
+                zip(remaining_samples, decoded_texts, outputs),
+                total=len(remaining_samples),
+                desc="Predicting",
+            ):
+                label = label_finder(prediction, labels)
+
+                prediction_record = {
+                    "idx": idx,
+                    "text": sample["text"],
+                    "label": sample["label"],
+                    "prediction": label,
+                    "output": prediction,
+                    "documents": decoded_text,
+                    "inference_time": inference_time,
+                }
+                checkpoint_file.write(
+                    json.dumps(prediction_record, ensure_ascii=False) + "\n"
+                )
+                checkpoint_file.flush()
+                predictions.append(prediction_record)
+    finally:
+        # Do not wait for the queued requests if a request failed
+        executor.shutdown(cancel_futures=True)
+
     # Save predictions to JSON file
+    predictions.sort(key=lambda prediction: prediction["idx"])
     save_json(save_path, predictions)
+    checkpoint_path.unlink()
@@ -18,6 +18,7 @@ from trl import SFTTrainer
 
 from social_llama.data_processing.combine import Combined
 from social_llama.data_processing.instruction_socket import InstructionSocket
+from social_llama.data_processing.packing import PackedDataset
 from social_llama.data_processing.social_dimensions import SocialDimensions
 from social_llama.data_processing.socket import Socket
 
@@ -48,7 +49,11 @@ class ScriptArguments:
         default=1024, metadata={"help": "the sequence length"}
     )
     num_workers: Optional[int] = field(
-        default=10, metadata={"help": "the number of workers"}
+        default=10,
+        metadata={"help": "the number of DataLoader workers preparing the batches"},
+    )
+    prefetch_factor: Optional[int] = field(
+        default=4, metadata={"help": "the number of batches prefetched per worker"}
     )
     num_train_epochs: Optional[int] = field(
         default=1, metadata={"help": "the number of training epochs"}
@@ -190,6 +195,10 @@ tokenizer.pad_token = tokenizer.eos_token
 tokenizer.padding_side = "right"  # Fix weird overflow issue with fp16 training
 tokenizer.verbose = False
 
+# Each worker iterates over its own share of the packed sequences, while the ConstantLengthDataset
+# of trl would be iterated in full by every worker, repeating the sequences
+num_workers = script_args.num_workers if isinstance(train_dataset, PackedDataset) else 0
+
 training_args = TrainingArguments(
     output_dir=output_dir,
     per_device_train_batch_size=script_args.per_device_train_batch_size,
@@ -208,6 +217,12 @@ training_args = TrainingArguments(
     # fp16=True,
     bf16=True,
     remove_unused_columns=False,
+    # Workers prepare the next batches in the background while the current one trains
+    dataloader_num_workers=num_workers,
+    dataloader_pin_memory=torch.cuda.is_available(),
+    # Prefetching and keeping the workers alive between epochs need worker processes
+    dataloader_prefetch_factor=script_args.prefetch_factor if num_workers > 0 else None,
+    dataloader_persistent_workers=num_workers > 0,
     run_name=f"sft_{script_args.model_name.split('/')[-1]}_{script_args.task}_{script_args.dataset_name}_{script_args.note}",
     seed=42,
 )
@@ -1,13 +1,31 @@
 """General utilities."""
 
+import copy
 import json
+import string
+import time
+from functools import lru_cache
 from pathlib import Path
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import Iterable
 from typing import List
+from typing import TypeVar
 from typing import Union
 
+import numpy as np
 import torch
+from datasets import Dataset
+from huggingface_hub.errors import GenerationError
+from huggingface_hub.errors import OverloadedError
+from huggingface_hub.errors import ValidationError
+from requests import RequestException
+from transformers import AutoTokenizer
+from transformers import PreTrainedTokenizerBase
+
+
+T = TypeVar("T")
 
 
 def get_device() -> torch.device:
@@ -24,6 +42,130 @@ def get_device() -> torch.device:
     return device
 
 
+def select_random_rows(dataset: Dataset, num_rows: int, seed: int = 42) -> Dataset:
+    """Select random rows from a dataset.
+
+    Gives the same rows as dataset.shuffle(seed=seed).select(range(num_rows)),
+    but only the selected rows are taken instead of shuffling the whole table first.
+
+    Raises:
+        ValueError: If the dataset has fewer than num_rows rows
+    """
+    if num_rows > len(dataset):
+        raise ValueError(
+            f"Cannot select {num_rows} rows from a dataset with {len(dataset)} rows."
+        )
+    indices = np.random.default_rng(seed).permutation(len(dataset))[:num_rows]
+    return dataset.select(indices)
+
+
+def call_with_retries(
+    func: Callable[..., T],
+    *args: Any,
+    max_attempts: int = 6,
+    initial_delay: float = 1.0,
+    max_delay: float = 60.0,
+    **kwargs: Any,
+) -> T:
+    r"""Call a function, retrying rate limits, server errors and network errors with exponential backoff.
+
+    Rate limited requests, and text generation servers reporting they are overloaded, wait for the
+    Retry-After header when the server sends one. Other client errors, e.g. authentication errors or
+    invalid requests, and text generation validation and generation errors are raised right away.
+
+    Args:
+        func (Callable[..., T]): Function to call
+        \*args (Any): Positional arguments for the function
+        max_attempts (int, optional): Maximum number of calls. Defaults to 6.
+        initial_delay (float, optional): Seconds to wait after the first failure. Defaults to 1.0.
+        max_delay (float, optional): Maximum seconds to wait between calls. Defaults to 60.0.
+        \*\*kwargs (Any): Keyword arguments for the function
+
+    Returns:
+        T: Return value of the function
+
+    Raises:
+        RequestException: If the error is not retryable, or the last attempt fails
+        TimeoutError: If the last attempt times out
+        ValueError: If max_attempts is less than 1
+    """
+    for attempt in range(max_attempts):
+        try:
+            return func(*args, **kwargs)
+        except (ValidationError, GenerationError):
+            # Errors of the request or the generation itself, a retry fails the same way
+            raise
+        except (RequestException, TimeoutError) as e:
+            if isinstance(e, OverloadedError):
+                # Built from the error message only, the response is on the HTTP error it wraps
+                response = getattr(e.__cause__, "response", None)
+                status_code = 429
+            else:
+                response = getattr(e, "response", None)
+                status_code = response.status_code if response is not None else None
+            if status_code is not None and status_code != 429 and status_code < 500:
+                raise
+            if attempt == max_attempts - 1:
+                raise
+
+            delay = min(max_delay, initial_delay * 2**attempt)
+            retry_after = (
+                response.headers.get("Retry-After", "") if response is not None else ""
+            )
+            if status_code == 429 and retry_after.isdigit():
+                delay = float(retry_after)
+            time.sleep(delay)
+
+    raise ValueError("max_attempts must be at least 1.")
+
+
+def compile_template(template: str) -> Callable[..., str]:
+    """Compiles a format string, parsing it once instead of on every format call.
+
+    Templates with fields other than plain names, such as {0}, {text!r} or {text:>10},
+    are left to str.format, so the result is always the same as formatting the template.
+
+    Args:
+        template (str): Format string with named fields, such as {context} and {text}.
+
+    Returns:
+        render (Callable[..., str]): Function filling the fields from keyword arguments.
+    """
+    # Pairs of literal text and the name of the field following it
+    parts = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(
+        template
+    ):
+        if field_name is not None and (
+            format_spec or conversion or not field_name.isidentifier()
+        ):
+            return lambda **kwargs: template.format(**kwargs)
+        parts.append((literal, field_name))
+
+    def render(**kwargs: str) -> str:
+        return "".join(
+            literal + (kwargs[field_name] if field_name is not None else "")
+            for literal, field_name in parts
+        )
+
+    return render
+
+
+@lru_cache(maxsize=None)
+def _load_tokenizer(model_id: str, **kwargs: Any) -> PreTrainedTokenizerBase:
+    """Load a tokenizer once per model and arguments."""
+    return AutoTokenizer.from_pretrained(model_id, **kwargs)
+
+
+def load_tokenizer(model_id: str, **kwargs: Any) -> PreTrainedTokenizerBase:
+    """Load a tokenizer, reading the files once per model and arguments.
+
+    Every caller gets its own copy, so attributes such as pad_token and padding_side
+    set by one caller are not seen by the others.
+    """
+    return copy.deepcopy(_load_tokenizer(model_id, **kwargs))
+
+
 def read_json(path: Path) -> List[Dict[str, Union[str, int]]]:
     """Read json from path."""
     with open(path) as file:
@@ -40,3 +182,11 @@ def save_json(path: Path, container: Iterable) -> None:
 
     with open(path, "w", encoding="utf-8") as outfile:
         json.dump(container, outfile, ensure_ascii=False, indent=4)
+
+
+def read_jsonl(path: Path) -> List[Dict[str, Any]]:
+    """Read json lines from path, returning an empty list if the file does not exist."""
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
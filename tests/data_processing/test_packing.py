@@ -0,0 +1,88 @@
+"""Test the packing of pre-tokenized examples."""
+
+import itertools
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from social_llama.data_processing.packing import PackedDataset
+
+
+EOS = 0
+
+
+class TestPackedDataset(unittest.TestCase):
+    """Test cases for the PackedDataset."""
+
+    def setUp(self):
+        """Set up the test cases."""
+        # 3 + 1, 2 + 1, 4 + 1 and 1 + 1 tokens with the EOS separators, 13 in total
+        self.input_ids = [[1, 2, 3], [4, 5], [6, 7, 8, 9], [10]]
+
+    def _sequences(self, dataset):
+        return [sample["input_ids"].tolist() for sample in dataset]
+
+    def test_sequences_are_cut_from_the_concatenated_examples(self):
+        """Test the sequence boundaries, the EOS separators and the dropped remainder."""
+        dataset = PackedDataset(self.input_ids, EOS, seq_length=4, shuffle=False)
+        self.assertEqual(
+            self._sequences(dataset),
+            [[1, 2, 3, EOS], [4, 5, EOS, 6], [7, 8, 9, EOS]],
+        )
+
+    def test_labels_are_the_input_ids(self):
+        """Test that the labels are a copy of the input ids."""
+        dataset = PackedDataset(self.input_ids, EOS, seq_length=4, shuffle=False)
+        for sample in dataset:
+            self.assertEqual(sample["labels"].tolist(), sample["input_ids"].tolist())
+            self.assertNotEqual(
+                sample["labels"].data_ptr(), sample["input_ids"].data_ptr()
+            )
+
+    def test_shuffle_keeps_the_sequences(self):
+        """Test that shuffling only changes the order of the sequences."""
+        sequences = self._sequences(
+            PackedDataset(self.input_ids, EOS, seq_length=2, shuffle=False)
+        )
+        shuffled = self._sequences(
+            PackedDataset(self.input_ids, EOS, seq_length=2, shuffle=True)
+        )
+        self.assertCountEqual(shuffled, sequences)
+
+    def test_too_few_tokens_raise(self):
+        """Test that examples not filling a single sequence raise a ValueError."""
+        with self.assertRaises(ValueError):
+            PackedDataset(self.input_ids, EOS, seq_length=1024)
+
+    def test_worker_shares_do_not_overlap(self):
+        """Test that the DataLoader workers together yield every sequence once."""
+        sequences = self._sequences(
+            PackedDataset(self.input_ids, EOS, seq_length=2, shuffle=False)
+        )
+        dataset = PackedDataset(self.input_ids, EOS, seq_length=2, shuffle=True)
+        shares = []
+        for worker_id in range(3):
+            worker_info = SimpleNamespace(id=worker_id, num_workers=3)
+            with mock.patch(
+                "social_llama.data_processing.packing.get_worker_info",
+                return_value=worker_info,
+            ):
+                shares.append(self._sequences(dataset))
+        self.assertTrue(all(shares))
+        self.assertCountEqual(list(itertools.chain(*shares)), sequences)
+
+    def test_infinite_restarts(self):
+        """Test that an infinite dataset yields every sequence again on the next pass."""
+        dataset = PackedDataset(self.input_ids, EOS, seq_length=4, infinite=True)
+        samples = self._sequences(itertools.islice(dataset, 6))
+        self.assertCountEqual(samples[:3], samples[3:])
+
+    def test_infinite_worker_without_sequences_stops(self):
+        """Test that an infinite dataset stops in a worker whose share is empty."""
+        dataset = PackedDataset(self.input_ids, EOS, seq_length=4, infinite=True)
+        worker_info = SimpleNamespace(id=3, num_workers=4)
+        with mock.patch(
+            "social_llama.data_processing.packing.get_worker_info",
+            return_value=worker_info,
+        ):
+            self.assertEqual(self._sequences(dataset), [])
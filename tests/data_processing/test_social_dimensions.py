@@ -1,11 +1,22 @@
 """Testing the social dimensions dataclass."""
 
 
+import itertools
+import json
+import pickle
+import random
+import tempfile
 import unittest
 from dataclasses import asdict
+from dataclasses import replace
+from pathlib import Path
+from typing import Any
 from typing import Dict
+from typing import List
+from unittest import mock
 
 from datasets import Dataset
+from datasets.fingerprint import Hasher
 
 from social_llama.data_processing.social_dimensions import Sample
 from social_llama.data_processing.social_dimensions import SocialDimensions
@@ -246,5 +257,236 @@ Answer: power [/INST]""",  # noqa
         # )
 
 
+def social_dimensions_without_tokenizer(task: str) -> SocialDimensions:
+    """Make a SocialDimensions with a mocked tokenizer, for tests that do not tokenize."""
+    with mock.patch(
+        "social_llama.data_processing.dataclass.load_tokenizer"
+    ) as load_tokenizer:
+        load_tokenizer.return_value.is_fast = True
+        return SocialDimensions(task=task, model="meta-llama/Llama-2-7b-chat-hf")
+
+
+def reference_few_shot_groups(
+    dataset: Dataset, labels: List[str], num_few_shot_examples: int, seed: int = 42
+) -> List[List[dict]]:
+    """Select the few shot examples the straightforward way, rebuilding the remaining examples each round."""
+    remaining = dataset.shuffle(seed=seed)
+    groups = []
+    while len(remaining) >= num_few_shot_examples:
+        label_examples: Dict[str, List[dict]] = {label: [] for label in labels}
+        for example in remaining:
+            if example["response_good"] in labels:
+                label_examples[example["response_good"]].append(example)
+
+        few_shot_examples: List[dict] = []
+        labels_cycle = itertools.cycle(labels)
+        while len(few_shot_examples) < num_few_shot_examples:
+            label = next(labels_cycle)
+            if label_examples[label]:
+                few_shot_examples.append(label_examples[label].pop(0))
+
+        random.seed(seed)
+        random.shuffle(few_shot_examples)
+
+        used_texts = {example["text"] for example in few_shot_examples}
+        remaining = [x for x in remaining if x["text"] not in used_texts]
+        groups.append(few_shot_examples)
+    return groups
+
+
+class TestSocialDimensionsFewShot(unittest.TestCase):
+    """Test the few shot selection of the SocialDimensions against a reference selection."""
+
+    def setUp(self):
+        """Set up the test cases, without downloading a tokenizer."""
+        self.social_dimensions = social_dimensions_without_tokenizer("few-shot")
+        self.social_dimensions.config = replace(
+            self.social_dimensions.config, num_few_shot_examples=3
+        )
+        self.labels = self.social_dimensions.config.labels
+
+    def _dataset(self, labels: List[str], duplicated_texts: int = 0) -> Dataset:
+        # An example per label, the last duplicated_texts examples repeat earlier texts
+        rows = [
+            {
+                "idx": str(i),
+                "text": f"text {i % (len(labels) - duplicated_texts)}",
+                "h_text": f"h_text {i}",
+                "response_good": label,
+                "response_bad": "other",
+            }
+            for i, label in enumerate(labels)
+        ]
+        return Dataset.from_list(rows)
+
+    def _assert_same_as_reference(self, dataset: Dataset):
+        expected = reference_few_shot_groups(dataset, self.labels, 3)
+        few_shot_dataset = self.social_dimensions._apply_few_shot_prompt_dpo(dataset)
+        self.assertEqual(
+            few_shot_dataset["idx"], [[x["idx"] for x in g] for g in expected]
+        )
+        self.assertEqual(
+            few_shot_dataset["response_good"],
+            [[x["response_good"] for x in g] for g in expected],
+        )
+        few_shot_texts = self.social_dimensions._apply_few_shot_prompt_stf(dataset)
+        self.assertEqual(
+            few_shot_texts["text"],
+            [self.social_dimensions._make_few_shot_example(g) for g in expected],
+        )
+
+    def test_balanced_labels(self):
+        """Test examples spread over several labels."""
+        labels = [self.labels[i % 4] for i in range(20)]
+        self._assert_same_as_reference(self._dataset(labels))
+
+    def test_labels_run_out(self):
+        """Test that the selection continues with the other labels when a label runs out."""
+        labels = ["conflict"] * 7 + ["trust"] * 2 + ["fun"]
+        self._assert_same_as_reference(self._dataset(labels))
+
+    def test_single_label_stops_with_the_remainder(self):
+        """Test that the loop stops once fewer examples than a few shot example are left."""
+        dataset = self._dataset(["conflict"] * 7)
+        self._assert_same_as_reference(dataset)
+        few_shot_dataset = self.social_dimensions._apply_few_shot_prompt_dpo(dataset)
+        self.assertEqual(len(few_shot_dataset), 2)
+
+    def test_duplicated_texts_are_used_once(self):
+        """Test that examples sharing a text with an earlier few shot example are skipped."""
+        labels = [self.labels[i % 5] for i in range(24)]
+        dataset = self._dataset(labels, duplicated_texts=8)
+        self._assert_same_as_reference(dataset)
+        few_shot_dataset = self.social_dimensions._apply_few_shot_prompt_dpo(dataset)
+        group_texts = [set(group) for group in few_shot_dataset["text"]]
+        for earlier, later in itertools.combinations(group_texts, 2):
+            self.assertFalse(earlier & later)
+
+
+def reference_json_rows(data: List[Dict[str, Any]], labels: List[str]) -> List[dict]:
+    """Expand the examples row by row, with the negative labels to draw response_bad from."""
+    rows = []
+    for idx, example in enumerate(data):
+        labels_counts = [
+            (label, value) for label, value in example.items() if label in labels
+        ]
+        positive_labels = [label for label, value in labels_counts if value > 0]
+        negative_labels = [label for label, value in labels_counts if value == 0]
+        for positive in positive_labels:
+            rows.append(
+                {
+                    "idx": str(idx),
+                    "text": example["text"],
+                    "h_text": example["h_text"],
+                    "response_good": positive,
+                    "negative_labels": negative_labels,
+                }
+            )
+    return rows
+
+
+class TestSimpleJsonSolution(unittest.TestCase):
+    """Test the expansion of the raw data into a sample per positive label."""
+
+    def setUp(self):
+        """Set up the test cases, without downloading a tokenizer."""
+        self.social_dimensions = social_dimensions_without_tokenizer("zero-shot")
+        # The labels are in another order than in the config, as in the raw files
+        self.data = [
+            # Several positives, and labels missing from the example
+            {
+                "text": "a",
+                "h_text": "ha",
+                "power": 3,
+                "fun": 0,
+                "trust": 1,
+                "conflict": 2,
+            },
+            # No positive labels, so the example is skipped
+            {
+                "text": "b",
+                "h_text": "hb",
+                "power": 0,
+                "fun": 0,
+                "trust": 0,
+                "conflict": 0,
+            },
+            # A single negative label
+            {"text": "c", "h_text": "hc", "fun": 0, "respect": 3},
+            # A key that is not a label
+            {
+                "text": "d",
+                "h_text": "hd",
+                "power": 1,
+                "fun": 0,
+                "trust": 0,
+                "annotator": 4,
+            },
+        ]
+
+    def _run(self) -> List[dict]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "labeled_dataset.json"
+            path.write_text(json.dumps(self.data))
+            self.social_dimensions.config = replace(
+                self.social_dimensions.config, path=path
+            )
+            with mock.patch(
+                "social_llama.data_processing.social_dimensions.save_json"
+            ) as save_json:
+                self.social_dimensions.simple_json_solution()
+        return save_json.call_args.args[1]
+
+    def test_same_samples_as_the_row_loop(self):
+        """Test that the samples match the per row loop, with a negative label of the same example."""
+        expected = reference_json_rows(self.data, self.social_dimensions.config.labels)
+        for _ in range(10):
+            samples = self._run()
+            self.assertEqual(
+                [{k: v for k, v in s.items() if k != "response_bad"} for s in samples],
+                [
+                    {k: v for k, v in e.items() if k != "negative_labels"}
+                    for e in expected
+                ],
+            )
+            for sample, example in zip(samples, expected):
+                self.assertIn(sample["response_bad"], example["negative_labels"])
+
+    def test_single_negative_is_always_chosen(self):
+        """Test that an example with one negative label always gets that label."""
+        for _ in range(10):
+            samples = self._run()
+            self.assertEqual(
+                [s["response_bad"] for s in samples if s["idx"] == "2"], ["fun"]
+            )
+
+
+class TestSocialDimensionsPromptCache(unittest.TestCase):
+    """Test that the cache of rendered prompts stays out of the pickled state."""
+
+    def setUp(self):
+        """Set up the test cases, with a picklable stand-in for the tokenizer."""
+        self.social_dimensions = social_dimensions_without_tokenizer("zero-shot")
+        self.social_dimensions.tokenizer = None
+
+    def test_cache_is_not_pickled(self):
+        """Test that the cached prompts are left out of the pickle."""
+        self.social_dimensions._prompt_cache["task prompt"] = "rendered prompt"
+        unpickled = pickle.loads(pickle.dumps(self.social_dimensions))
+        self.assertEqual(unpickled._prompt_cache, {})
+        self.assertEqual(unpickled.model, self.social_dimensions.model)
+        self.assertEqual(
+            self.social_dimensions._prompt_cache, {"task prompt": "rendered prompt"}
+        )
+
+    def test_fingerprint_does_not_depend_on_the_cache(self):
+        """Test that the hash of the map function is the same before and after caching prompts."""
+        before = Hasher.hash(self.social_dimensions._prompt_function_batch)
+        self.social_dimensions._prompt_cache["task prompt"] = "rendered prompt"
+        self.assertEqual(
+            Hasher.hash(self.social_dimensions._prompt_function_batch), before
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
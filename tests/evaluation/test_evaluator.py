@@ -0,0 +1,127 @@
+"""Test the prompts of the evaluator."""
+import unittest
+
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast
+
+from social_llama.evaluation.evaluator import Evaluator
+
+
+LLAMA_3_CHAT_TEMPLATE = (
+    "{% set loop_messages = messages %}{% for message in loop_messages %}"
+    "{% set content = '<|start_header_id|>' + message['role'] + '<|end_header_id|>\n\n'"
+    " + message['content'] | trim + '<|eot_id|>' %}"
+    "{% if loop.index0 == 0 %}{% set content = bos_token + content %}{% endif %}"
+    "{{ content }}{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{% endif %}"
+)
+
+GEMMA_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% if messages[0]['role'] == 'system' %}"
+    "{{ raise_exception('System role not supported') }}{% endif %}"
+    "{% for message in messages %}"
+    "{% if (message['role'] == 'assistant') %}{% set role = 'model' %}"
+    "{% else %}{% set role = message['role'] %}{% endif %}"
+    "{{ '<start_of_turn>' + role + '\n' + message['content'] | trim + '<end_of_turn>\n' }}"
+    "{% endfor %}{% if add_generation_prompt %}{{'<start_of_turn>model\n'}}{% endif %}"
+)
+
+PROMPTS = ("Text: {text}", "{text}", "Is this text sarcastic? {text}")
+
+TEXTS = (
+    "a plain text",
+    "a text with {braces} and {0} and {}",
+    "{text}",
+    "{",
+    " leading whitespace",
+    "trailing whitespace\n",
+    "\ttabs on both sides\t",
+    " ",
+    "\n\n",
+    "",
+)
+
+
+def chat_tokenizer(chat_template: str) -> PreTrainedTokenizerFast:
+    """Build a tokenizer that only renders the chat template, without a vocabulary to download."""
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(WordLevel({"<unk>": 0}, unk_token="<unk>")),
+        bos_token="<bos>",
+        unk_token="<unk>",
+    )
+    tokenizer.chat_template = chat_template
+    return tokenizer
+
+
+class TestCompilePrompt(unittest.TestCase):
+    """Test that the compiled SOCKET prompts are the same as the prompts rendered in full."""
+
+    def _evaluator(self, chat_template: str, system_layout: bool) -> Evaluator:
+        # The prompt methods only need the tokenizer and the chat layout
+        evaluator = Evaluator.__new__(Evaluator)
+        evaluator.tokenizer = chat_tokenizer(chat_template)
+        evaluator._build_chat = (
+            evaluator._build_chat_system
+            if system_layout
+            else evaluator._build_chat_user
+        )
+        return evaluator
+
+    def _assert_same_prompts(self, evaluator: Evaluator, sample_text: str) -> None:
+        label_list = '"sarcastic", "not sarcastic"'
+        system_content = "You are a helpful assistant. "
+        for prompt in PROMPTS:
+
+            def render(text: str, prompt: str = prompt) -> str:
+                return evaluator._prompt_socket(
+                    text, prompt, label_list, system_content
+                )
+
+            compiled = evaluator._compile_prompt(render, sample_text)
+            for text in TEXTS:
+                with self.subTest(prompt=prompt, sample_text=sample_text, text=text):
+                    self.assertEqual(compiled(text), render(text))
+
+    def test_llama_3_system_layout(self):
+        """Test the prompts of the Llama 3 chat template with a system message."""
+        evaluator = self._evaluator(LLAMA_3_CHAT_TEMPLATE, system_layout=True)
+        for sample_text in TEXTS:
+            self._assert_same_prompts(evaluator, sample_text)
+
+    def test_gemma_user_layout(self):
+        """Test the prompts of the Gemma chat template with the system message in the user turn."""
+        evaluator = self._evaluator(GEMMA_CHAT_TEMPLATE, system_layout=False)
+        for sample_text in TEXTS:
+            self._assert_same_prompts(evaluator, sample_text)
+
+    def test_text_is_filled_in_without_rendering(self):
+        """Test that a text without whitespace at the edges skips the chat template."""
+        evaluator = self._evaluator(LLAMA_3_CHAT_TEMPLATE, system_layout=True)
+        rendered = []
+
+        def render(text: str) -> str:
+            rendered.append(text)
+            return evaluator._prompt_socket(text, "Text: {text}", '"a", "b"', "")
+
+        compiled = evaluator._compile_prompt(render, "a plain text")
+        rendered.clear()
+        self.assertIn("a text with {braces}", compiled("a text with {braces}"))
+        self.assertEqual(rendered, [])
+        compiled(" leading whitespace")
+        self.assertEqual(rendered, [" leading whitespace"])
+
+    def test_falls_back_when_the_placeholder_is_not_kept(self):
+        """Test that every prompt is rendered in full when the text is not kept as is."""
+        evaluator = self._evaluator(LLAMA_3_CHAT_TEMPLATE, system_layout=True)
+
+        def render(text: str) -> str:
+            return evaluator._prompt_socket(text.upper(), "Text: {text}", "", "")
+
+        compiled = evaluator._compile_prompt(render, "a plain text")
+        self.assertIs(compiled, render)
+        self.assertEqual(compiled("a plain text"), render("a plain text"))
+
+
+if __name__ == "__main__":
+    unittest.main()
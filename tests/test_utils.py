@@ -0,0 +1,222 @@
+"""Test the general utilities."""
+
+import unittest
+from types import SimpleNamespace
+from typing import Dict
+from typing import Optional
+from unittest import mock
+
+from datasets import Dataset
+from huggingface_hub.errors import InferenceTimeoutError
+from huggingface_hub.errors import OverloadedError
+from huggingface_hub.errors import ValidationError
+from requests import HTTPError
+from requests import Response
+
+from social_llama.utils import _load_tokenizer
+from social_llama.utils import call_with_retries
+from social_llama.utils import compile_template
+from social_llama.utils import load_tokenizer
+from social_llama.utils import select_random_rows
+
+
+# Templates shaped like the rendered RAG chat templates, with the fields at the edges too
+TEMPLATES = (
+    "<s>[INST] <<SYS>>\nsystem\n<</SYS>>\n\ntask\nRetrieved Documents:\n{context}\n"
+    "Input Text: {text}\nAnswer: [/INST]",
+    "<start_of_turn>user\ntask\nRetrieved Documents:\n{context}\nInput Text: {text}\n"
+    "Answer:<end_of_turn>\n",
+    "{text}",
+    "{context}{text}",
+    "{text} and {context} and {text}",
+    "Escaped {{braces}} around {text}, a lone }} and {{",
+    "",
+    "no fields at all",
+)
+
+VALUES = (
+    "a plain text",
+    "a text with {braces} and {0} and {}",
+    "{context}",
+    " leading and trailing whitespace\n",
+    " ",
+    "\n\t",
+    "",
+)
+
+
+def http_error(status_code: int, headers: Optional[Dict[str, str]] = None) -> HTTPError:
+    """Make an HTTP error with a response of the given status code and headers."""
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return HTTPError(f"{status_code} error", response=response)
+
+
+def overloaded_error(headers: Optional[Dict[str, str]] = None) -> OverloadedError:
+    """Make an OverloadedError wrapping a 429 HTTP error, as the inference client raises it."""
+    try:
+        try:
+            raise http_error(429, headers)
+        except HTTPError as e:
+            raise OverloadedError("Model is overloaded") from e
+    except OverloadedError as e:
+        return e
+
+
+@mock.patch("social_llama.utils.time.sleep")
+class TestCallWithRetries(unittest.TestCase):
+    """Test the call_with_retries function."""
+
+    def test_returns_on_success(self, sleep):
+        """Test that a successful call is made once."""
+        func = mock.Mock(return_value="output")
+        self.assertEqual(call_with_retries(func, "prompt", max_new_tokens=5), "output")
+        func.assert_called_once_with("prompt", max_new_tokens=5)
+        sleep.assert_not_called()
+
+    def test_client_error_is_raised_right_away(self, sleep):
+        """Test that client errors other than 429 are not retried."""
+        func = mock.Mock(side_effect=http_error(401))
+        with self.assertRaises(HTTPError):
+            call_with_retries(func)
+        self.assertEqual(func.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_validation_error_is_raised_right_away(self, sleep):
+        """Test that text generation validation errors, which have no response, are not retried."""
+        func = mock.Mock(side_effect=ValidationError("Input validation error"))
+        with self.assertRaises(ValidationError):
+            call_with_retries(func)
+        self.assertEqual(func.call_count, 1)
+        sleep.assert_not_called()
+
+    def test_rate_limit_waits_for_retry_after(self, sleep):
+        """Test that a 429 waits for the Retry-After header."""
+        func = mock.Mock(side_effect=[http_error(429, {"Retry-After": "7"}), "output"])
+        self.assertEqual(call_with_retries(func), "output")
+        sleep.assert_called_once_with(7.0)
+
+    def test_overloaded_error_waits_for_retry_after(self, sleep):
+        """Test that an OverloadedError is retried as a 429, with the Retry-After of the wrapped error."""
+        func = mock.Mock(side_effect=[overloaded_error({"Retry-After": "3"}), "output"])
+        self.assertEqual(call_with_retries(func), "output")
+        sleep.assert_called_once_with(3.0)
+
+    def test_server_error_backs_off_exponentially(self, sleep):
+        """Test that server errors are retried with exponential backoff."""
+        func = mock.Mock(side_effect=[http_error(503), http_error(500), "output"])
+        self.assertEqual(call_with_retries(func, initial_delay=2.0), "output")
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [2.0, 4.0])
+
+    def test_timeout_is_retried(self, sleep):
+        """Test that timeouts are retried."""
+        func = mock.Mock(side_effect=[InferenceTimeoutError("timed out"), "output"])
+        self.assertEqual(call_with_retries(func), "output")
+        self.assertEqual(func.call_count, 2)
+
+    def test_last_error_is_raised_when_attempts_run_out(self, sleep):
+        """Test that the last error is raised after max_attempts calls, with capped delays."""
+        func = mock.Mock(side_effect=http_error(502))
+        with self.assertRaises(HTTPError):
+            call_with_retries(func, max_attempts=4, initial_delay=1.0, max_delay=3.0)
+        self.assertEqual(func.call_count, 4)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [1.0, 2.0, 3.0])
+
+    def test_max_attempts_must_be_positive(self, sleep):
+        """Test that max_attempts=0 raises a ValueError without calling the function."""
+        func = mock.Mock()
+        with self.assertRaises(ValueError):
+            call_with_retries(func, max_attempts=0)
+        func.assert_not_called()
+
+
+class TestCompileTemplate(unittest.TestCase):
+    """Test that compile_template renders the same prompts as str.format."""
+
+    def test_same_as_format(self):
+        """Test templates with escaped braces and fields at the edges, filled with any text."""
+        for template in TEMPLATES:
+            render = compile_template(template)
+            for context in VALUES:
+                for text in VALUES:
+                    with self.subTest(template=template, context=context, text=text):
+                        self.assertEqual(
+                            render(context=context, text=text),
+                            template.format(context=context, text=text),
+                        )
+
+    def test_fields_left_to_format(self):
+        """Test that conversions, format specs and positional fields give the str.format result."""
+        for template in ("{text!r}", "{text:>12}", "{text:{width}}", "{text.upper}"):
+            with self.subTest(template=template):
+                self.assertEqual(
+                    compile_template(template)(text="a text", width="8"),
+                    template.format(text="a text", width="8"),
+                )
+        with self.assertRaises(IndexError):
+            compile_template("{0}")(text="a text")
+
+    def test_missing_field_raises_key_error(self):
+        """Test that a missing field raises a KeyError, as str.format does."""
+        with self.assertRaises(KeyError):
+            compile_template("{context} {text}")(text="a text")
+
+    def test_unbalanced_braces_raise_value_error(self):
+        """Test that an invalid template raises a ValueError, as str.format does."""
+        with self.assertRaises(ValueError):
+            compile_template("a lone { brace")
+
+
+class TestSelectRandomRows(unittest.TestCase):
+    """Test the select_random_rows function."""
+
+    def setUp(self):
+        """Set up a dataset with a row per index."""
+        self.dataset = Dataset.from_dict({"idx": list(range(10))})
+
+    def test_selects_distinct_rows(self):
+        """Test that the selected rows are distinct and the same for the same seed."""
+        rows = select_random_rows(self.dataset, 4, seed=1)["idx"]
+        self.assertEqual(len(set(rows)), 4)
+        self.assertEqual(select_random_rows(self.dataset, 4, seed=1)["idx"], rows)
+
+    def test_all_rows(self):
+        """Test that selecting every row gives a permutation of the dataset."""
+        rows = select_random_rows(self.dataset, 10)["idx"]
+        self.assertEqual(sorted(rows), list(range(10)))
+
+    def test_too_many_rows_raise_value_error(self):
+        """Test that asking for more rows than the dataset has raises a ValueError."""
+        with self.assertRaises(ValueError):
+            select_random_rows(self.dataset, 11)
+
+
+@mock.patch("social_llama.utils.AutoTokenizer.from_pretrained")
+class TestLoadTokenizer(unittest.TestCase):
+    """Test the load_tokenizer function."""
+
+    def setUp(self):
+        """Start every test without cached tokenizers."""
+        _load_tokenizer.cache_clear()
+
+    def tearDown(self):
+        """Leave no mocked tokenizers in the cache."""
+        _load_tokenizer.cache_clear()
+
+    def test_files_are_read_once(self, from_pretrained):
+        """Test that the tokenizer is loaded once per model and arguments."""
+        from_pretrained.side_effect = lambda model_id, **kwargs: SimpleNamespace()
+        load_tokenizer("model", use_fast=True)
+        load_tokenizer("model", use_fast=True)
+        load_tokenizer("model", use_fast=False)
+        self.assertEqual(from_pretrained.call_count, 2)
+
+    def test_callers_get_their_own_copy(self, from_pretrained):
+        """Test that attributes set by one caller do not leak into the others."""
+        from_pretrained.return_value = SimpleNamespace(padding_side="right")
+        first = load_tokenizer("model")
+        first.padding_side = "left"
+        second = load_tokenizer("model")
+        self.assertIsNot(first, second)
+        self.assertEqual(second.padding_side, "right")